@@ -0,0 +1,12 @@
+#!/bin/sh
+### Build the road network of one region from data/REGION/target.osm to the CSR graph bundle data/REGION/network_csr/
+### Usage: sh build_network.sh REGION [TILES] [PROCESSES]
+### The ways are cleaned in TILES x TILES tiles by PROCESSES processes (default: 1 tile, 1 process); large extracts are read streaming
+### target.osm is read with --streaming: an overpass json extract needs ijson (pip install ijson), an OSM xml extract needs no extra package
+region=${1:-sf}
+tiles=${2:-1}
+processes=${3:-1}
+cd "$(dirname "$0")/scripts" || exit 1
+python3 1_osm2json.py --region "$region" --streaming --tiles "$tiles" --processes "$processes" || exit 1
+python3 2_json2graph.py "$region" || exit 1
+python3 3_graph_to_mtx.py "$region"
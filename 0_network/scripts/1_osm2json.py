@@ -6,92 +6,70 @@ import numpy as np
 import re
 import sys
 import random
+import argparse
+import itertools
+from multiprocessing import Pool
 
 # user defined module
 import haversine
+from osm_reader import read_osm
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))+'/../../utilities')
+from results_writer import write_geojson
 
 '''
 Code structure:
  * main:
+    ** read_osm (osm_reader.py): load the OSM data, either all at once or streaming in two passes (ways first, then only the coordinates of the nodes they reference).
     ** osm_to_geojson: convert data from .osm to .geojson for visualization.
     ** osm_to_json: clean data from .osm by removing curve nodes (nodes that only represent link geometry but not meaningful graph nodes), output the converted data into nodes.json and ways.json, with the option to output the .geojson format as well.
-        *** create_way: (called by osm_to_json) handle one OSM way element by removing curve nodes, add default or OSM-provided information of number of lanes, maximum speed (mph) and capacity.
+        *** split_tiles, count_node_refs, find_intersections, simplify_ways: (called by osm_to_json) split the ways into tiles, find the intersection nodes over all tiles and remove the curve nodes of each tile's ways, in parallel over the tiles.
+        *** create_way: (called by simplify_ways) handle one OSM way element, once its curve nodes have been removed on the flattened node references of all ways, add default or OSM-provided information of number of lanes, maximum speed (mph) and capacity.
 
 Input:
- * target.osm as downloaded from OSM overpass.
+ * target.osm as downloaded from OSM overpass, in the json ([out:json]) or the OSM xml format. Streaming the json format needs ijson.
 
 Output:
- * osm_nodes.geojson: OSM node elements in .geojson format.
- * osm_ways.geojson: OSM way elements in .geojson format.
+ * osm_nodes.geojson (with --geojson): OSM node elements in .geojson format.
+ * osm_ways.geojson (with --geojson): OSM way elements in .geojson format.
  * nodes.json: nodes that we will keep to build the road network graph.
  * ways.json: ways that we will keep to build the road network graph.
- * converted_nodes.geojson: same as nodes.json but in .geojson format for easy visualisation.
- * converted_ways.geojson: same as ways.json but in .geojson format for easy visualisation.
+ * converted_nodes.geojson (with --geojson): same as nodes.json but in .geojson format for easy visualisation.
+ * converted_ways.geojson (with --geojson): same as ways.json but in .geojson format for easy visualisation.
 
 Next step:
- * gather the outputs and run `2_json2graph.py` to create python-igraph object.
+ * gather the outputs and run `2_json2graph.py` to create the graph (CSR bundle).
 '''
 
-def osm_to_geojson(folder='sf'):
+### Get drivable roads
+# In OSM, the following types of roads are one-way by default:
+drivable_oneway_default = ['motorway', 'motorway_link', 'motorway_junction', 'trunk', 'trunk_link']
+# These roads are two-way by default:
+drivable_twoway_default = ['primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified', 'unsurfaced', 'track', 'residential', 'living_street', 'service']
+
+def osm_to_geojson(folder='sf', streaming=False):
     ### converts OSM data to geojson format
     ### this is mainly for visualization as geojson format can be easily imported to QGIS
 
-    # Load OSM data as downloaded from overpass
+    # Load OSM data as downloaded from overpass: all way elements with a highway tag and the nodes they reference
     absolute_path = os.path.dirname(os.path.abspath(__file__))
-    osm_data = json.load(open(absolute_path+'/../data/{}/target.osm'.format(folder)))
-    osm_data = osm_data['elements']
-    print('length of the OSM data: ', len(osm_data))
-
-    # Based on the OSM data, make a dictionary of node elements: all_nodes = {osm_node_id:(lat,lon), ...}
-    all_nodes = {n['id']: (n['lat'], n['lon']) for n in osm_data if n['type']=='node'}
-    print('it includes {} nodes'.format(len(all_nodes)))
-
-    # Make a list of way elements
-    all_ways = [w_e for w_e in osm_data if w_e['type']=='way']
-    print('it includes {} nodes'.format(len(all_ways)))
-
-    nodes_feature_list = [] ### OSM node element to "Point" feature in geojson format
-    for k, v in all_nodes.items():
-        node_feature = {
-            'type': 'Feature', 
-            'geometry': {'type': 'Point', 'coordinates': [v[1], v[0]]},
-            'properties': {'osmid': k}
-            }
-        nodes_feature_list.append(node_feature)
-    nodes_geojson = {'type': 'FeatureCollection', 'features': nodes_feature_list}
-
-    links_feature_list = [] ### OSM way element to "LineString" feature in geojson format
-    for w in all_ways:
-        link_feature = {
-            'type': 'Feature', 
-            'geometry': {
-                'type': 'LineString', 
-                'coordinates': [[all_nodes[n][1], all_nodes[n][0]] for n in w['nodes']]
-                },
-            'properties': {
-                'osmid': w['id'],
-                'type': w['tags']['highway']
-                }
-            }
-        links_feature_list.append(link_feature)
-    links_geojson = {'type': 'FeatureCollection', 'features': links_feature_list}
-
-    # Save output
-    with open(absolute_path+'/../data/{}/osm_ways.geojson'.format(folder), 'w') as links_outfile:
-        json.dump(links_geojson, links_outfile, indent=2)
-
-    with open(absolute_path+'/../data/{}/osm_nodes.geojson'.format(folder), 'w') as nodes_outfile:
-        json.dump(nodes_geojson, nodes_outfile, indent=2)
-
-
-def create_way(w, intersection_nodes, oneway_str, reverse):
+    all_ways, (node_ids, node_lat, node_lon) = read_osm(absolute_path+'/../data/{}/target.osm'.format(folder), streaming=streaming)
+
+    # Save output, streamed from the coordinate arrays
+    way_refs, way_offsets = flatten_ways(all_ways)
+    way_index = np.searchsorted(node_ids, way_refs)
+    write_geojson(absolute_path+'/../data/{}/osm_ways.geojson'.format(folder),
+        np.column_stack((node_lon[way_index], node_lat[way_index])),
+        {'osmid': np.array([w['id'] for w in all_ways], dtype=np.int64), 'type': [w['tags']['highway'] for w in all_ways]},
+        offsets=way_offsets)
+
+    write_geojson(absolute_path+'/../data/{}/osm_nodes.geojson'.format(folder),
+        np.column_stack((node_lon, node_lat)), {'osmid': node_ids})
+
+
+def create_way(w, nodes_in_way, length_in_way, oneway_str, reverse):
     ### Process one "way" element in OSM
-    ### Remove curve nodes, add lanes, speed limit and capacity
+    ### Add lanes, speed limit and capacity to its intersection nodes and section lengths (curve nodes already removed by osm_to_json)
 
-    # Remove curve nodes by only keeping intersection nodes
-    nodes_in_way = [n for n in w['nodes'] if n in intersection_nodes]
-    nid_in_way = [i for i in range(len(w['nodes'])) if w['nodes'][i] in nodes_in_way]
-    length_in_way = [round(sum(w['length'][x:y]),2) for (x,y) in zip(nid_in_way, nid_in_way[1:])]
     if reverse:
         nodes_in_way = nodes_in_way[::-1]
         length_in_way = length_in_way[::-1]
@@ -149,131 +127,170 @@ def create_way(w, intersection_nodes, oneway_str, reverse):
         'nodes': nodes_in_way, 
         'length': length_in_way}
 
-    return way, nodes_in_way
+    return way
 
 
-def osm_to_json(output_geojson=False, folder = 'sf'):
-    ### Clean the OSM data by removing curve nodes, separate into nodes and ways, output .json (for further processing) and .geosjon (for visualisation).
+def flatten_ways(all_ways):
+    ### Flatten the node references of a list of ways: the nodes of all_ways[i] are way_refs[way_offsets[i]:way_offsets[i+1]]
+    way_sizes = np.array([len(way['nodes']) for way in all_ways], dtype=np.int64)
+    way_offsets = np.zeros(len(all_ways)+1, dtype=np.int64)
+    np.cumsum(way_sizes, out=way_offsets[1:])
+    way_refs = np.fromiter((n for way in all_ways for n in way['nodes']), dtype=np.int64, count=way_offsets[-1])
+    return way_refs, way_offsets
+
+
+def count_node_refs(all_ways):
+    ### Count the references to each node in a list of ways (e.g., the ways of one tile)
+    ### Return the unique OSM node IDs, the number of references to each and whether it is the end node of a way
+    way_refs, way_offsets = flatten_ways(all_ways)
+    unique_refs, ref_inverse, ref_counts = np.unique(way_refs, return_inverse=True, return_counts=True)
+    is_end_node = np.zeros(len(unique_refs), dtype=bool)
+    is_end_node[ref_inverse[way_offsets[:-1]]] = True
+    is_end_node[ref_inverse[way_offsets[1:]-1]] = True
+    return unique_refs, ref_counts, is_end_node
 
-    # Load OSM data as downloaded from overpass
-    absolute_path = os.path.dirname(os.path.abspath(__file__))
-    osm_data = json.load(open(absolute_path+'/../data/{}/target.osm'.format(folder)))
-    osm_data = osm_data['elements']
-    print('length of the OSM data: ', len(osm_data))
-
-    # Based on the OSM data, make a dictionary of node element: all_nodes = {osm_node_id:(lat,lon), ...}
-    all_nodes = {n['id']: (n['lat'], n['lon']) for n in osm_data if n['type']=='node'}
-    print('it includes {} nodes'.format(len(all_nodes)))
-    random_key = random.choice(list(all_nodes))
-    print('example, {}: {}'.format(random_key, all_nodes[random_key]))
-
-    # Make a list of way elements
-    all_ways = [w_e for w_e in osm_data if w_e['type']=='way']
-    print('it includes {} nodes'.format(len(all_ways)))
-    end_nodes_l = [] # list holding all end nodes of the way elements. All will be preserved.
-    mid_nodes_l = [] # list holding all mid nodes of the way elements. Some will be discarded as curve nodes.
-    ###################### lecture break ############################
-    for way in all_ways:
-        way_nodes = way['nodes']
-        end_nodes_l.append(way_nodes[0])
-        end_nodes_l.append(way_nodes[-1])
-        mid_nodes_l += way_nodes[1:-1]
-        # Use harversine formula to calculate the length between two nodes. Set length as 0.1 if calculated distance is smaller
-        # some nodes will be cleaned as they define curves rather than intersections. However, the length between two nodes will contribute to the final total length
-        way['length'] = [max(0.1, haversine.haversine(all_nodes[x][0], all_nodes[x][1], all_nodes[y][0], all_nodes[y][1])) for (x,y) in zip(way_nodes, way_nodes[1:])]
-        #pprint.pprint(way)
-        #sys.exit(0)
 
+def find_intersections(node_ref_counts):
+    ### Merge the outputs of count_node_refs for several groups of ways, return the sorted OSM IDs of the intersection nodes
     # critieria for filtering out curve nodes, but preserve intersections:
     # 1. all end nodes are preserved
-    # 2. nodes are preserved if it appears twice or more in mid_nodes_l + end_nodes_l
+    # 2. nodes are preserved if it appears twice or more in the node references of all ways (end and mid nodes)
     # The final set of nodes is the the union of results from the above two criteria
-    # Find duplicates: https://stackoverflow.com/a/9835819
-    all_nodes_l = end_nodes_l + mid_nodes_l # all nodes with duplicates
-    seen = set()
-    dupes = set()
-    for n in all_nodes_l:
-        if n not in seen:
-            seen.add(n)
-        else:
-            dupes.add(n)
-    intersection_nodes = set(end_nodes_l).union(dupes)
-    print(len(all_nodes_l), len(set(end_nodes_l)), len(seen), len(dupes), len(intersection_nodes))
-
-    ### Get drivable roads
-    # In OSM, the following types of roads are one-way by default:
-    drivable_oneway_default = ['motorway', 'motorway_link', 'motorway_junction', 'trunk', 'trunk_link']
-    # These roads are two-way by default:
-    drivable_twoway_default = ['primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified', 'unsurfaced', 'track', 'residential', 'living_street', 'service']
-
+    # A node on the boundary of two tiles is counted in both, so its references add up as if the ways were never split
+    unique_refs, ref_inverse = np.unique(np.concatenate([refs for (refs, counts, ends) in node_ref_counts]), return_inverse=True)
+    ref_counts = np.bincount(ref_inverse, weights=np.concatenate([counts for (refs, counts, ends) in node_ref_counts]))
+    is_end_node = np.bincount(ref_inverse, weights=np.concatenate([ends for (refs, counts, ends) in node_ref_counts])) > 0
+    intersection_nodes = is_end_node | (ref_counts >= 2)
+    print(int(np.sum(ref_counts)), np.count_nonzero(is_end_node), len(unique_refs), np.count_nonzero(ref_counts >= 2), np.count_nonzero(intersection_nodes))
+    return unique_refs[intersection_nodes]
+
+
+def simplify_ways(all_ways, node_coords, intersection_ids):
+    ### Remove the curve nodes of a list of ways by only keeping the nodes in intersection_ids, return the cleaned way elements
+    node_ids, node_lat, node_lon = node_coords
+    way_refs, way_offsets = flatten_ways(all_ways)
+    ref_index = np.searchsorted(node_ids, way_refs) ### position of each referenced node in the coordinate arrays
+
+    # Use harversine formula to calculate the length between each two consecutive nodes of the same way. Set length as 0.1 if calculated distance is smaller
+    # some nodes will be cleaned as they define curves rather than intersections. However, the length between two nodes will contribute to the final total length
+    # segment_length[i] is the length from way_refs[i] to way_refs[i+1], 0 at the last node of each way
+    segment_length = np.zeros(len(way_refs))
+    segment_length[:-1] = np.maximum(0.1, haversine.haversine_array(
+        node_lat[ref_index[:-1]], node_lon[ref_index[:-1]], node_lat[ref_index[1:]], node_lon[ref_index[1:]]))
+    segment_length[way_offsets[1:]-1] = 0
+
+    # Remove curve nodes by only keeping intersection nodes. As the end nodes of each way are kept,
+    # the length of the section starting at each kept node is the sum of the segment lengths up to the next kept node
+    intersection_index = np.minimum(np.searchsorted(intersection_ids, way_refs), len(intersection_ids)-1)
+    kept = np.flatnonzero(intersection_ids[intersection_index] == way_refs)
+    section_length = np.round(np.add.reduceat(segment_length, kept), 2)
+    kept_offsets = np.searchsorted(kept, way_offsets) ### kept nodes of all_ways[i] are kept[kept_offsets[i]:kept_offsets[i+1]]
+    kept_refs = way_refs[kept].tolist()
+    section_length = section_length.tolist()
+
+    ### Get drivable roads (drivable_oneway_default and drivable_twoway_default, see the top of this file)
     ways_list = []
-    nodes_in_ways_list = []
-    for w in all_ways:
+    for i, w in enumerate(all_ways):
+        nodes_in_way = kept_refs[kept_offsets[i]:kept_offsets[i+1]]
+        length_in_way = section_length[kept_offsets[i]:(kept_offsets[i+1]-1)] ### the last kept node of a way starts no section
         if w['tags']['highway'] in drivable_oneway_default:
-            way, nodes_in_way = create_way(w, intersection_nodes, 'y', False)
+            way = create_way(w, nodes_in_way, length_in_way, 'y', False)
             ways_list.append(way)
-            nodes_in_ways_list += nodes_in_way
         if w['tags']['highway'] in drivable_twoway_default:
             if ('oneway' in w['tags']) and (w['tags']['oneway'] in ['yes', 'true', '1']):
-                way, nodes_in_way = create_way(w, intersection_nodes, 'y', False)
+                way = create_way(w, nodes_in_way, length_in_way, 'y', False)
                 ways_list.append(way)
-                nodes_in_ways_list += nodes_in_way
             elif ('oneway' in w['tags']) and w['tags']['oneway'] in ['reverse', '-1']:
-                way, nodes_in_way = create_way(w, intersection_nodes, 'y', True)
+                way = create_way(w, nodes_in_way, length_in_way, 'y', True)
                 ways_list.append(way)
-                nodes_in_ways_list += nodes_in_way
             else:
-                way, nodes_in_way = create_way(w, intersection_nodes, 'nf', False) ### twoway and the forward lane direction
+                way = create_way(w, nodes_in_way, length_in_way, 'nf', False) ### twoway and the forward lane direction
                 ways_list.append(way)
-                nodes_in_ways_list += nodes_in_way
-                way, nodes_in_way = create_way(w, intersection_nodes, 'nb', True) ### twoway and the reverse/backward lane direction
+                way = create_way(w, nodes_in_way, length_in_way, 'nb', True) ### twoway and the reverse/backward lane direction
                 ways_list.append(way)
-                nodes_in_ways_list += nodes_in_way
+
+    return ways_list
+
+
+def split_tiles(all_ways, node_coords, tiles):
+    ### Split the ways into a tiles x tiles grid over the bounding box of the nodes, by the location of the first node of each way
+    ### Return a list of (ways, node_coords) per non-empty tile, node_coords only holding the nodes referenced by the ways of the tile
+    node_ids, node_lat, node_lon = node_coords
+    first_index = np.searchsorted(node_ids, [way['nodes'][0] for way in all_ways])
+    def grid_cell(values):
+        ### cell of each value in tiles equal intervals between the minimum and the maximum
+        cell_size = (np.nanmax(values) - np.nanmin(values)) / tiles
+        if not cell_size > 0: return np.zeros(len(values), dtype=np.int64)
+        return np.clip(((values - np.nanmin(values)) // cell_size), 0, tiles-1).astype(np.int64)
+    way_tile = (grid_cell(node_lat)[first_index] * tiles + grid_cell(node_lon)[first_index]) if len(all_ways) > 0 else np.zeros(0, dtype=np.int64)
+
+    tile_list = []
+    for tile in np.unique(way_tile):
+        tile_ways = [all_ways[i] for i in np.flatnonzero(way_tile == tile)]
+        tile_index = np.searchsorted(node_ids, np.unique(flatten_ways(tile_ways)[0]))
+        tile_list.append((tile_ways, (node_ids[tile_index], node_lat[tile_index], node_lon[tile_index])))
+    return tile_list
+
+
+def osm_to_json(output_geojson=False, folder = 'sf', streaming=False, tiles=1, processes=1):
+    ### Clean the OSM data by removing curve nodes, separate into nodes and ways, output .json (for further processing) and .geosjon (for visualisation).
+    ### For large regions, tiles > 1 splits the ways into tiles x tiles tiles that are cleaned in parallel by processes worker processes,
+    ### and stitched back into one network: the intersections are found over all tiles and each node is output once
+
+    # Load OSM data as downloaded from overpass, only keeping the drivable way elements and the nodes they reference
+    # Node coordinates are in numpy arrays sorted by OSM node ID, node_ids[i]: (node_lat[i], node_lon[i])
+    absolute_path = os.path.dirname(os.path.abspath(__file__))
+    all_ways, (node_ids, node_lat, node_lon) = read_osm(
+        absolute_path+'/../data/{}/target.osm'.format(folder),
+        highway_types=drivable_oneway_default+drivable_twoway_default, streaming=streaming)
+    random_index = random.randrange(len(node_ids))
+    print('example, {}: {}'.format(node_ids[random_index], (float(node_lat[random_index]), float(node_lon[random_index]))))
+
+    tile_list = split_tiles(all_ways, (node_ids, node_lat, node_lon), tiles)
+    print('{} ways in {} tiles'.format(len(all_ways), len(tile_list)))
+    del all_ways
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        starmap = pool.starmap if pool is not None else lambda f, args: list(itertools.starmap(f, args))
+        intersection_ids = find_intersections(starmap(count_node_refs, [(tile_ways,) for (tile_ways, tile_coords) in tile_list]))
+        tile_ways_lists = starmap(simplify_ways, [(tile_ways, tile_coords, intersection_ids) for (tile_ways, tile_coords) in tile_list])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    ways_list = [way for tile_ways_list in tile_ways_lists for way in tile_ways_list]
 
     with open(absolute_path+'/../data/{}/ways.json'.format(folder), 'w') as links_outfile:
         json.dump(ways_list, links_outfile, indent=2)
 
-    nodes_in_ways_set = set(nodes_in_ways_list)
-    nodes_in_links_dict = {n: all_nodes[n] for n in nodes_in_ways_set}
+    nodes_in_ways_index = np.searchsorted(node_ids, intersection_ids)
+    nodes_in_links_dict = {n: (lat, lon) for (n, lat, lon) in zip(node_ids[nodes_in_ways_index].tolist(), node_lat[nodes_in_ways_index].tolist(), node_lon[nodes_in_ways_index].tolist())}
     with open(absolute_path+'/../data/{}/nodes.json'.format(folder), 'w') as nodes_outfile:
         json.dump(nodes_in_links_dict, nodes_outfile, indent=2)
 
     if output_geojson:
-        nodes_feature_list = []
-        for k, v in nodes_in_links_dict.items():
-            node_feature = {
-                'type': 'Feature', 
-                'geometry': {'type': 'Point', 'coordinates': [v[1], v[0]]},
-                'properties': {'osmid': k}
-                }
-            nodes_feature_list.append(node_feature)
-        nodes_geojson = {'type': 'FeatureCollection', 'features': nodes_feature_list}
-
-        links_feature_list = []
-        for w in ways_list:
-            link_feature = {
-                'type': 'Feature', 
-                'geometry': {
-                    'type': 'LineString', 
-                    'coordinates': [[nodes_in_links_dict[n][1], nodes_in_links_dict[n][0]] for n in w['nodes']]
-                    },
-                'properties': {
-                    'osmid': w['osmid'],
-                    'type': w['type']
-                    }
-                }
-            links_feature_list.append(link_feature)
-        links_geojson = {'type': 'FeatureCollection', 'features': links_feature_list}
-
-        with open(absolute_path+'/../data/{}/converted_ways.geojson'.format(folder), 'w') as links_outfile:
-            json.dump(links_geojson, links_outfile, indent=2)
-
-        with open(absolute_path+'/../data/{}/convertd_nodes.geojson'.format(folder), 'w') as nodes_outfile:
-            json.dump(nodes_geojson, nodes_outfile, indent=2)
+        nodes_index = np.searchsorted(node_ids, intersection_ids)
+        write_geojson(absolute_path+'/../data/{}/convertd_nodes.geojson'.format(folder),
+            np.column_stack((node_lon[nodes_index], node_lat[nodes_index])), {'osmid': intersection_ids})
 
-
-if __name__ == '__main__':
-    osm_to_geojson(folder = 'sf')
-    osm_to_json(output_geojson=True, folder = 'sf')
+        way_refs, way_offsets = flatten_ways(ways_list)
+        way_index = np.searchsorted(node_ids, way_refs)
+        write_geojson(absolute_path+'/../data/{}/converted_ways.geojson'.format(folder),
+            np.column_stack((node_lon[way_index], node_lat[way_index])),
+            {'osmid': np.array([w['osmid'] for w in ways_list], dtype=np.int64), 'type': [w['type'] for w in ways_list]},
+            offsets=way_offsets)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean the OSM data of a region into nodes.json and ways.json')
+    parser.add_argument('--region', default='sf', help='folder of the region under data/, containing target.osm')
+    ### read target.osm in two passes instead of loading it at once, for extracts larger than the memory
+    parser.add_argument('--streaming', action='store_true', help='read target.osm in two streaming passes')
+    parser.add_argument('--tiles', type=int, default=1, help='clean the ways in tiles x tiles tiles of the region')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes cleaning the tiles')
+    ### the GeoJSON files are only for visualisation, and osm_to_geojson reads every highway=* way of target.osm again
+    parser.add_argument('--geojson', action='store_true', help='also write target.osm and the cleaned network as GeoJSON, e.g., for QGIS')
+    args = parser.parse_args()
+    if args.geojson:
+        osm_to_geojson(folder = args.region, streaming=args.streaming)
+    osm_to_json(output_geojson=args.geojson, folder = args.region, streaming=args.streaming, tiles=args.tiles, processes=args.processes)
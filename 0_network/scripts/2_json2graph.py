@@ -1,112 +1,94 @@
 ### Convert the imputed weekday/weekend & hourly specific link-level travel time file to graph objects.
 import json
 import sys
-import haversine
-import igraph
 import os
 import numpy as np
 
 absolute_path = os.path.dirname(os.path.abspath(__file__))
-folder = 'sf'
+folder = sys.argv[1] if len(sys.argv) > 1 else 'sf' ### region folder under data/
+
+sys.path.insert(0, absolute_path+'/../../utilities')
+from csr_graph import write_csr_graph
+from results_writer import write_geojson
 
 ### Construct the graph nodes from nodes.json
+### Node ID on graph is the position in nodes.json; OSM IDs are mapped to it through a sorted index and np.searchsorted
 nodes_json = json.load(open(absolute_path+'/../data/{}/nodes.json'.format(folder)))
 print('number of nodes: ', len(nodes_json))
-node_index = 0
-node_data = []
-for n, cor in nodes_json.items():
-    node_element = {
-    'node_osmid': n,
-    'node_index': node_index,
-    'n_x': cor[1],
-    'n_y': cor[0]}
-    node_data.append(node_element)
-    node_index += 1
+node_osmid = np.array([int(n) for n in nodes_json.keys()], dtype=np.int64)
+node_coords = np.array(list(nodes_json.values()), dtype=np.float64).reshape(-1, 2) ### lat, lon
+node_x, node_y = node_coords[:,1], node_coords[:,0]
+osmid_order = np.argsort(node_osmid)
+sorted_osmid = node_osmid[osmid_order]
+
+def osmid_to_graphid(osmids):
+    ### Node IDs on graph of an array of OSM node IDs, -1 for those not in nodes.json
+    index = np.minimum(np.searchsorted(sorted_osmid, osmids), len(sorted_osmid)-1)
+    return np.where(sorted_osmid[index] == osmids, osmid_order[index], -1)
 
-### Construct the graph edges
+### Construct the graph edges: one edge per section between two consecutive nodes of a way, as flat arrays
 ways_json = json.load(open(absolute_path+'/../data/{}/ways.json'.format(folder)))
 print('number of edges: ', len(ways_json))
-#edge_index = 0
-edge_data = []
-edge_nodes_set = set()
-for way in ways_json:
-    for section_ct in range(len(way['nodes'])-1):
-        edge_element = {
-        'edge_osmid': way['osmid'],
-        #'edge_index': edge_index,
-        'start_node': str(way['nodes'][section_ct]),
-        'end_node': str(way['nodes'][section_ct+1]),
-        'type': way['type'],
-        'lane': way['lanes'],
-        'maxmph': way['maxmph'],
-        'capacity': way['capacity'],
-        'sec_length': way['length'][section_ct]
-        }
-        edge_nodes_set.add(edge_element['start_node'])
-        edge_nodes_set.add(edge_element['end_node'])
-        edge_data.append(edge_element)
-        #edge_index += 1
+way_sections = np.array([len(way['nodes'])-1 for way in ways_json], dtype=np.int64)
+start_osmid = np.fromiter((n for way in ways_json for n in way['nodes'][:-1]), dtype=np.int64, count=np.sum(way_sections))
+end_osmid = np.fromiter((n for way in ways_json for n in way['nodes'][1:]), dtype=np.int64, count=np.sum(way_sections))
+sec_length = np.fromiter((l for way in ways_json for l in way['length']), dtype=np.float64, count=np.sum(way_sections))
+edge_osmid = np.repeat(np.array([way['osmid'] for way in ways_json], dtype=np.int64), way_sections)
+edge_type = np.repeat(np.array([way['type'] for way in ways_json], dtype=str), way_sections)
+lanes = np.repeat(np.array([way['lanes'] for way in ways_json], dtype=np.float64), way_sections)
+maxmph = np.repeat(np.array([way['maxmph'] for way in ways_json], dtype=np.float64), way_sections)
+capacity = np.repeat(np.array([way['capacity'] for way in ways_json], dtype=np.float64), way_sections)
+start_node = osmid_to_graphid(start_osmid)
+end_node = osmid_to_graphid(end_osmid)
 
 ### Check if all nodes in the edge dataset are contained in the provided nodes dataset
-print('Are all nodes in edges in nodes.json: ', edge_nodes_set.issubset(set([*nodes_json])))
+print('Are all nodes in edges in nodes.json: ', bool(np.all(start_node >= 0) and np.all(end_node >= 0)))
+print('graph: {} nodes, {} edges'.format(len(node_osmid), len(start_node)))
 
-### Construct the graph object
-g = igraph.Graph.DictList(
-    vertices=node_data,
-    edges=edge_data, 
-    vertex_name_attr='node_osmid',
-    edge_foreign_keys=('start_node','end_node'),
-    directed=True)
-print(g.summary())
-g.simplify(multiple=True, loops=True, 
-    combine_edges=dict(
-        edge_osmid="first", edge_index="first", start_node="first", end_node="first",
-        type="first", lane="sum", maxmph="mean", capacity="sum", sec_length="max"))
-g.es['edge_index'] = list(range(g.ecount()))
-print(g.summary())
+### Simplify the graph: drop self loops and merge parallel edges between the same two nodes with a group-by on the (start, end) pair
+### The merged edge keeps the OSM ID and type of the first section, the sum of lanes and capacity, the mean speed limit and the longest length
+### Edges are ordered by start node, then end node
+keep = (start_node != end_node) & (start_node >= 0) & (end_node >= 0)
+pair_key = start_node[keep] * len(node_osmid) + end_node[keep]
+pair_key, first_section, pair_inverse = np.unique(pair_key, return_index=True, return_inverse=True)
+edge_count = np.bincount(pair_inverse)
+edge_source, edge_target = pair_key // len(node_osmid), pair_key % len(node_osmid)
+edge_osmid, edge_type = edge_osmid[keep][first_section], edge_type[keep][first_section]
+lanes = np.bincount(pair_inverse, weights=lanes[keep])
+capacity = np.bincount(pair_inverse, weights=capacity[keep])
+maxmph = np.bincount(pair_inverse, weights=maxmph[keep]) / edge_count
+merged_length = np.full(len(pair_key), -np.inf)
+np.maximum.at(merged_length, pair_inverse, sec_length[keep])
+sec_length = merged_length
+print('graph after merging parallel edges: {} nodes, {} edges'.format(len(node_osmid), len(pair_key)))
 
-g.write_pickle(absolute_path+'/../data/{}/network_graph.pkl'.format(folder)) ### Save as pkl for preserving coordinate precision
+### Save as a binary CSR bundle (.npy arrays, memory-mappable, full coordinate precision) for the ABM and the utilities
+### 2.23694 is to convert mph to m/s; fft is the free flow time in seconds
+write_csr_graph(absolute_path+'/../data/{}/network_csr'.format(folder), edge_source, edge_target, len(node_osmid),
+    edge_attrs={
+        'edge_osmid': edge_osmid,
+        'type': edge_type,
+        'lanes': lanes,
+        'maxmph': maxmph,
+        'capacity': capacity,
+        'length': sec_length,
+        'fft': sec_length/maxmph*2.23694},
+    node_attrs={
+        'node_osmid': node_osmid,
+        'node_x': node_x,
+        'node_y': node_y})
 
-node_osmid2graphid_dict = dict(zip(g.vs['node_osmid'], range(g.vcount())))
+node_osmid2graphid_dict = dict(zip(node_osmid.tolist(), range(len(node_osmid))))
 with open(absolute_path+'/../data/{}/node_osmid2graphid.json'.format(folder), 'w') as outfile:
     json.dump(node_osmid2graphid_dict, outfile, indent=2)
 
 save_geojson = True
 if save_geojson:
-    nodes_feature_list = []
-    for v in g.vs:
-        node_feature = {
-            'type': 'Feature', 
-            'geometry': {'type': 'Point', 'coordinates': [v['n_x'], v['n_y']]},
-            'properties': {'osmid': v['node_osmid'], 'gid': v['node_index']}
-            }
-        nodes_feature_list.append(node_feature)
-    nodes_geojson = {'type': 'FeatureCollection', 'features': nodes_feature_list}
-
-    edges_feature_list = []
-    for e in g.es:
-        edge_feature = {
-            'type': 'Feature', 
-            'geometry': {
-                'type': 'LineString', 
-                'coordinates': [[g.vs[e.source]['n_x'], g.vs[e.source]['n_y']], [g.vs[e.target]['n_x'], g.vs[e.target]['n_y']]]
-                },
-            'properties': {
-                'osmid': e['edge_osmid'],
-                'gid': e['edge_index'],
-                'type': e['type'],
-                'lane': e['lane'],
-                'maxmph': e['maxmph'],
-                'capacity': e['capacity'],
-                'sec_length': e['sec_length']
-                }
-            }
-        edges_feature_list.append(edge_feature)
-    edges_geojson = {'type': 'FeatureCollection', 'features': edges_feature_list}
-
-    with open(absolute_path+'/../data/{}/graph_edges.geojson'.format(folder), 'w') as edges_outfile:
-        json.dump(edges_geojson, edges_outfile, indent=2)
-
-    with open(absolute_path+'/../data/{}/graph_nodes.geojson'.format(folder), 'w') as nodes_outfile:
-        json.dump(nodes_geojson, nodes_outfile, indent=2)
+    ### Streamed from the arrays, one straight LineString per edge
+    write_geojson(absolute_path+'/../data/{}/graph_edges.geojson'.format(folder),
+        np.column_stack((node_x[edge_source], node_y[edge_source], node_x[edge_target], node_y[edge_target])).reshape(-1, 2),
+        {'osmid': edge_osmid, 'gid': np.arange(len(edge_source)), 'type': edge_type, 'lane': lanes, 'maxmph': maxmph, 'capacity': capacity, 'sec_length': sec_length},
+        offsets=np.arange(0, 2*len(edge_source)+1, 2))
 
+    write_geojson(absolute_path+'/../data/{}/graph_nodes.geojson'.format(folder),
+        np.column_stack((node_x, node_y)), {'osmid': node_osmid, 'gid': np.arange(len(node_osmid))})
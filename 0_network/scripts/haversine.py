@@ -1,5 +1,6 @@
 #! Python 3
 from math import radians, cos, sin, asin, sqrt
+import numpy as np
 
 def haversine(lat1, lon1, lat2, lon2):
     """
@@ -16,4 +17,15 @@ def haversine(lat1, lon1, lat2, lon2):
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
     c = 2 * asin(sqrt(a)) 
     r = 6371 # Radius of earth in kilometers. Use 3956 for miles
-    return c * r * 1000
\ No newline at end of file
+    return c * r * 1000
+def haversine_array(lat1, lon1, lat2, lon2):
+    """
+    Same as haversine, for numpy arrays of points: the distances (m) between (lat1[i], lon1[i]) and (lat2[i], lon2[i])
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1 
+    dlat = lat2 - lat1 
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a)) 
+    r = 6371 # Radius of earth in kilometers
+    return c * r * 1000
@@ -0,0 +1,83 @@
+#! Python 3
+### Read the OSM data as downloaded from overpass, either the json output ([out:json]) or the OSM xml format
+### With streaming=True the extract is read in two passes and never held in memory as a whole:
+###  * pass 1 keeps the way elements of the selected highway types and collects the node IDs they reference;
+###  * pass 2 keeps the coordinates of only those nodes, in numpy arrays sorted by OSM node ID.
+### Peak memory is then bounded by the selected road network, not by the raw extract.
+### Streaming the json output needs ijson (https://pypi.org/project/ijson/); the xml format only needs the standard library.
+import json
+import numpy as np
+import xml.etree.ElementTree as ET
+
+node_chunk_size = 1000000 ### node elements looked up at once in pass 2
+
+def osm_format(osm_file):
+    ### 'xml' or 'json', from the first non-blank character of the file
+    with open(osm_file) as f:
+        while True:
+            c = f.read(1)
+            if c == '' or not c.isspace():
+                return 'xml' if c == '<' else 'json'
+
+def iter_xml_elements(osm_file, element_type):
+    ### Yield the node or way elements of an OSM xml file, in the same layout as the overpass json output
+    for event, elem in ET.iterparse(osm_file, events=('end',)):
+        if elem.tag == element_type == 'node':
+            yield {'type': 'node', 'id': int(elem.get('id')), 'lat': float(elem.get('lat')), 'lon': float(elem.get('lon'))}
+        elif elem.tag == element_type == 'way':
+            yield {
+                'type': 'way', 'id': int(elem.get('id')),
+                'nodes': [int(nd.get('ref')) for nd in elem.iter('nd')],
+                'tags': {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}}
+        if elem.tag in ('node', 'way', 'relation'):
+            elem.clear() ### free the element once it has been read
+
+def iter_osm_elements(osm_file, element_type):
+    ### Yield the node or way elements of the OSM file one at a time
+    if osm_format(osm_file) == 'xml':
+        yield from iter_xml_elements(osm_file, element_type)
+    else:
+        import ijson
+        with open(osm_file, 'rb') as f:
+            for element in ijson.items(f, 'elements.item', use_float=True):
+                if element['type'] == element_type: yield element
+
+def read_osm(osm_file, highway_types=None, streaming=False):
+    ### Return the way elements with a highway tag (of highway_types, if given) and the coordinates of the nodes they reference
+    ### Node coordinates are returned as (node_ids, node_lat, node_lon), sorted by OSM node ID; look them up with np.searchsorted
+    if streaming or osm_format(osm_file) == 'xml': ### the xml format is always parsed incrementally
+        elements = lambda element_type: iter_osm_elements(osm_file, element_type)
+    else:
+        osm_data = json.load(open(osm_file))['elements']
+        print('length of the OSM data: ', len(osm_data))
+        elements = lambda element_type: (e for e in osm_data if e['type']==element_type)
+
+    # Pass 1: ways, only keeping what the network builder needs
+    ways = []
+    for w in elements('way'):
+        if 'highway' not in w.get('tags', {}): continue
+        if (highway_types is not None) and (w['tags']['highway'] not in highway_types): continue
+        ways.append({'type': 'way', 'id': w['id'], 'nodes': w['nodes'], 'tags': w['tags']})
+    print('it includes {} ways'.format(len(ways)))
+    node_ids = np.unique(np.fromiter((n for w in ways for n in w['nodes']), dtype=np.int64))
+
+    # Pass 2: coordinates of the referenced nodes
+    node_lat = np.full(len(node_ids), np.nan)
+    node_lon = np.full(len(node_ids), np.nan)
+    def add_nodes(chunk):
+        if len(node_ids) == 0: return
+        chunk_ids = np.array([n['id'] for n in chunk], dtype=np.int64)
+        index = np.minimum(np.searchsorted(node_ids, chunk_ids), len(node_ids)-1)
+        found = node_ids[index] == chunk_ids
+        node_lat[index[found]] = [n['lat'] for (n, f) in zip(chunk, found) if f]
+        node_lon[index[found]] = [n['lon'] for (n, f) in zip(chunk, found) if f]
+    chunk = []
+    for n in elements('node'):
+        chunk.append(n)
+        if len(chunk) >= node_chunk_size:
+            add_nodes(chunk)
+            chunk = []
+    add_nodes(chunk)
+    print('it includes {} nodes referenced by the ways, {} of them without coordinates'.format(len(node_ids), np.count_nonzero(np.isnan(node_lat))))
+
+    return ways, (node_ids, node_lat, node_lon)
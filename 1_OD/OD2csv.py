@@ -5,40 +5,90 @@ import sys
 import matplotlib.path as mpltPath
 import numpy as np 
 import scipy.sparse 
-from collections import Counter
-import random 
-import itertools 
 import os 
+import argparse
+from multiprocessing import Pool
 
 absolute_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, absolute_path+'/../utilities')
+from od_table import write_od_table
 
 ################################################################
 ### Estabilish relationship between OSM/graph nodes and TAZs ###
 ################################################################
 
-def find_in_nodes(row, points, nodes_df):
-    ### return the indices of points in nodes_df that are contained in row['geometry']
+class NodeGrid(object):
+    ### Uniform grid over the node coordinates, to find the nodes in a bounding box without testing all of them
+    ### Nodes are sorted by grid cell (row by row), so that the cells of one grid row within a bounding box are one contiguous range
+    def __init__(self, points, nodes_per_cell=16):
+        self.points = points
+        self.origin = points.min(axis=0)
+        extent = np.maximum(points.max(axis=0) - self.origin, 1e-9)
+        self.cell_size = np.sqrt(extent[0]*extent[1]*nodes_per_cell/len(points))
+        self.shape = (extent // self.cell_size).astype(np.int64) + 1 ### columns (x), rows (y)
+        cells = ((points - self.origin) // self.cell_size).astype(np.int64)
+        cell_id = cells[:,1] * self.shape[0] + cells[:,0]
+        self.order = np.argsort(cell_id, kind='stable')
+        self.cell_start = np.searchsorted(cell_id[self.order], np.arange(self.shape[0]*self.shape[1]+1))
+
+    def query_bbox(self, minx, miny, maxx, maxy):
+        ### indices of the points within the bounding box
+        x0, y0 = np.clip(((np.array([minx, miny]) - self.origin) // self.cell_size).astype(np.int64), 0, self.shape-1)
+        x1, y1 = np.clip(((np.array([maxx, maxy]) - self.origin) // self.cell_size).astype(np.int64), 0, self.shape-1)
+        candidates = np.concatenate([np.empty(0, dtype=np.int64)] + [
+            self.order[self.cell_start[y*self.shape[0]+x0]:self.cell_start[y*self.shape[0]+x1+1]] for y in range(y0, y1+1)])
+        candidate_points = self.points[candidates]
+        in_bbox = (candidate_points[:,0] >= minx) & (candidate_points[:,0] <= maxx) & (candidate_points[:,1] >= miny) & (candidate_points[:,1] <= maxy)
+        return candidates[in_bbox]
+
+def find_in_nodes(geometry, points, grid):
+    ### return the indices of points that are contained in geometry (Polygon or MultiPolygon, holes excluded)
+    ### only the points in the bounding box of each polygon are tested
     ### this function is called by TAZ_nodes()
-    if row['geometry'].type == 'MultiPolygon':
-        return []
-    else:
-        path = mpltPath.Path(list(zip(*row['geometry'].exterior.coords.xy)))
-        in_index = path.contains_points(points)
-        return nodes_df['index'].loc[in_index].tolist()
+    polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+    in_index = []
+    for polygon in polygons:
+        candidates = grid.query_bbox(*polygon.bounds)
+        if len(candidates) == 0: continue
+        inside = mpltPath.Path(np.asarray(polygon.exterior.coords)[:,:2]).contains_points(points[candidates])
+        for interior in polygon.interiors:
+            inside &= ~mpltPath.Path(np.asarray(interior.coords)[:,:2]).contains_points(points[candidates])
+        in_index.append(candidates[inside])
+    return np.unique(np.concatenate(in_index)) if in_index else np.empty(0, dtype=np.int64)
+
+def find_nearest_nodes(geometry, points, grid, boundary_tolerance):
+    ### return the indices of points within boundary_tolerance (degrees) of geometry, or of the nearest point if there is none
+    ### for TAZs without any node inside, e.g., TAZ=741 in downtown SF, whose nodes are all on its boundary
+    minx, miny, maxx, maxy = geometry.bounds
+    candidates = grid.query_bbox(minx-boundary_tolerance, miny-boundary_tolerance, maxx+boundary_tolerance, maxy+boundary_tolerance)
+    if len(candidates) > 0:
+        distance = gpd.GeoSeries.from_xy(points[candidates,0], points[candidates,1]).distance(geometry).values
+        if np.any(distance <= boundary_tolerance):
+            return candidates[distance <= boundary_tolerance]
+    center = np.asarray(geometry.representative_point().coords)[0]
+    return np.array([np.argmin(np.sum((points - center)**2, axis=1))])
 
-def TAZ_nodes():
-    ### Find corresponding nodes for each TAZ
+def TAZ_nodes(network_folder=absolute_path+'/../data_repo/data/sf', boundary_tolerance=0.0005):
+    ### Find corresponding nodes for each TAZ: the nodes inside the TAZ polygon(s), found through a grid index over the nodes
+    ### A TAZ without any node inside gets the nodes within boundary_tolerance (degrees, 0.0005 is about 50m) of its boundary,
+    ### or the single nearest node, so that every TAZ has nodes to sample from
     ### Input 1: TAZ polyline
     taz_gdf = gpd.read_file(absolute_path+'/TAZ981/TAZ981.shp')
     taz_gdf = taz_gdf.to_crs({'init': 'epsg:4326'})
 
     ### Input 2: OSM nodes coordinate
-    nodes_dict = json.load(open(absolute_path+'/../data_repo/data/sf/nodes.json'))
-    nodes_df = pd.DataFrame.from_dict(nodes_dict, orient='index', columns=['lat', 'lon']).reset_index()
+    nodes_dict = json.load(open(network_folder+'/nodes.json'))
+    nodes_osmid = np.array(list(nodes_dict.keys()))
+    points = np.array(list(nodes_dict.values()), dtype=np.float64).reshape(-1, 2)[:, ::-1] ### lon, lat
+    grid = NodeGrid(points)
 
-    points = nodes_df[['lon', 'lat']].values
-    taz_gdf['in_nodes'] = taz_gdf.apply(lambda row: find_in_nodes(row, points, nodes_df), axis=1)
-    taz_nodes_dict = {row['TAZ']:row['in_nodes'] for index, row in taz_gdf.iterrows()}
+    taz_nodes_dict = {}
+    for taz, geometry in zip(taz_gdf['TAZ'], taz_gdf['geometry']):
+        in_index = find_in_nodes(geometry, points, grid)
+        if len(in_index) == 0:
+            in_index = find_nearest_nodes(geometry, points, grid, boundary_tolerance)
+            print('TAZ {} has no node inside, using {} nodes on or near its boundary'.format(taz, len(in_index)))
+        taz_nodes_dict[int(taz)] = nodes_osmid[in_index].tolist()
     
     ### [{'taz': 1, 'in_nodes': '[...]''}, ...]
     with open(absolute_path+'/output/taz_nodes.json', 'w') as outfile:
@@ -49,99 +99,270 @@ def TAZ_nodes():
 ######### Sample nodes as OD based on TAZ-level results ########
 ################################################################
 
-def OD_iterations(OD, target_O, target_D):
-    ### one iteration of finding matrix elements based on row sums and column sums
+def balance_OD(target_O, target_D, tolerance=1e-6, max_iterations=100, dtype=np.float64):
+    ### Iterative proportional fitting of the OD matrices of several time slices at once, on a (slices x TAZ x TAZ) array
+    ### target_O, target_D: (slices x TAZ) row sums (pickups) and column sums (dropoffs)
+    ### Each iteration scales the columns, then the rows, in place; a slice stops once the relative error of its column sums is below tolerance
+    ### Rows and columns with a zero target are zero from the start, so no division by zero can happen
+    ### The dropoffs of each slice are rescaled to the total of its pickups, as the balanced matrix can only match margins with the same total
+    ### dtype=np.float32 halves the memory, e.g., 0.65GB instead of 1.3GB for 168 slices of 981 TAZs
+    ### The tolerance is kept above the rounding error of dtype, which a float32 column sum over thousands of TAZs cannot get below
+    tolerance = max(tolerance, 100*np.finfo(dtype).eps)
+    target_O = np.asarray(target_O, dtype=dtype)
+    target_D = np.asarray(target_D, dtype=dtype)
+    D_total = target_D.sum(axis=1, keepdims=True)
+    target_D = target_D * np.divide(target_O.sum(axis=1, keepdims=True), D_total, out=np.zeros_like(D_total), where=D_total>0)
+    OD = (target_O > 0)[:,:,None] * (target_D > 0)[:,None,:] ### masks of the zero margins
+    OD = OD.astype(dtype)
 
-    #print(np.min(target_D), np.max(target_D))
-    col_sum = OD.sum(axis=0)
-    D_coef = target_D/(col_sum+0.001)
-    OD = OD*D_coef
-    #print(np.max(col_sum), np.min(D_coef), np.max(D_coef), np.min(OD), np.max(OD))
+    iterations = np.zeros(len(OD), dtype=np.int64)
+    errors = np.full(len(OD), np.inf)
+    active = target_O.sum(axis=1) > 0
+    errors[~active] = 0
+    for i in range(max_iterations):
+        if not np.any(active): break
+        ### Work on the contiguous runs of active slices, as views of the array: no copies of the matrices
+        run_bounds = np.flatnonzero(np.diff(np.r_[0, active.astype(np.int8), 0]))
+        for run_start, run_end in zip(run_bounds[0::2], run_bounds[1::2]):
+            run = OD[run_start:run_end]
+            col_sum = run.sum(axis=1)
+            run *= np.divide(target_D[run_start:run_end], col_sum, out=np.zeros_like(col_sum), where=col_sum>0)[:,None,:]
+            row_sum = run.sum(axis=2)
+            run *= np.divide(target_O[run_start:run_end], row_sum, out=np.zeros_like(row_sum), where=row_sum>0)[:,:,None]
+            errors[run_start:run_end] = np.abs(target_D[run_start:run_end] - run.sum(axis=1)).sum(axis=1) / target_D[run_start:run_end].sum(axis=1)
+        iterations[active] = i+1
+        active &= errors > tolerance
 
-    row_sum = OD.sum(axis=1)
-    O_coef = target_O/(row_sum+0.001)
-    OD = (OD.T*O_coef).T
+    return OD, iterations, errors
 
-    col_sum = OD.sum(axis=0)
-    errors = np.sum(np.abs(target_D - col_sum))
 
-    #print(np.count_nonzero(np.isnan(errors)))
+def sparse_seed(taz_ids, max_distance=None, prior_file=None):
+    ### Seed of the OD matrix in CSR form (TAZ x TAZ, in the order of taz_ids), for zone systems too large for a dense matrix
+    ### Only its nonzero cells are balanced and sampled, e.g., the TAZ pairs within max_distance or the nonzero cells of a prior OD
+    ### prior_file: a scipy.sparse .npz matrix (scipy.sparse.save_npz), used as the seed values
+    ### max_distance: km between the TAZ centroids (TAZ981.shp); the seed is 1 for the pairs within it
+    if prior_file is not None:
+        return scipy.sparse.load_npz(prior_file).tocsr()
+    from scipy.spatial import cKDTree
+    taz_gdf = gpd.read_file(absolute_path+'/TAZ981/TAZ981.shp').to_crs({'init': 'epsg:4326'})
+    taz_gdf = taz_gdf[np.isin(taz_gdf['TAZ'].values, taz_ids)] ### only the TAZs with an OD matrix row
+    centroids = np.array([[geometry.centroid.x, geometry.centroid.y] for geometry in taz_gdf['geometry']])
+    ### km on a local equirectangular projection, accurate enough for a distance cutoff within a region
+    xy = np.column_stack((centroids[:,0]*111.32*np.cos(np.radians(np.mean(centroids[:,1]))), centroids[:,1]*110.57))
+    pairs = cKDTree(xy).query_pairs(max_distance, output_type='ndarray')
+    ### Rows and columns in the order of taz_ids; TAZs without a polygon only keep their diagonal cell
+    taz_index = np.searchsorted(taz_ids, taz_gdf['TAZ'].values)
+    rows = np.concatenate([taz_index[pairs[:,0]], taz_index[pairs[:,1]], np.arange(len(taz_ids))])
+    cols = np.concatenate([taz_index[pairs[:,1]], taz_index[pairs[:,0]], np.arange(len(taz_ids))])
+    return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(taz_ids), len(taz_ids)))
 
-    return OD, errors
+def balance_OD_sparse(seed_matrix, target_O, target_D, tolerance=1e-6, max_iterations=100):
+    ### Iterative proportional fitting of one OD matrix on the nonzero cells of seed_matrix (CSR), see balance_OD
+    ### Returns the balanced CSR matrix, the number of iterations and the relative error of the column sums
+    target_O = np.asarray(target_O, dtype=np.float64)
+    target_D = np.asarray(target_D, dtype=np.float64)
+    if np.sum(target_D) > 0: target_D = target_D * np.sum(target_O) / np.sum(target_D)
+    OD = seed_matrix.tocsr(copy=True)
+    OD.sum_duplicates()
+    cell_O = np.repeat(np.arange(OD.shape[0]), np.diff(OD.indptr)) ### row of each stored cell
+    OD.data = OD.data.astype(np.float64) * (target_O[cell_O] > 0) * (target_D[OD.indices] > 0) ### mask the zero margins
 
+    error = 0
+    for i in range(max_iterations):
+        col_sum = np.bincount(OD.indices, weights=OD.data, minlength=OD.shape[1])
+        OD.data *= np.divide(target_D, col_sum, out=np.zeros_like(col_sum), where=col_sum>0)[OD.indices]
+        row_sum = np.bincount(cell_O, weights=OD.data, minlength=OD.shape[0])
+        OD.data *= np.divide(target_O, row_sum, out=np.zeros_like(row_sum), where=row_sum>0)[cell_O]
+        col_sum = np.bincount(OD.indices, weights=OD.data, minlength=OD.shape[1])
+        error = np.sum(np.abs(target_D - col_sum)) / np.sum(target_D) if np.sum(target_D) > 0 else 0
+        if error <= tolerance: break
+    return OD, i+1, error
 
-def TAZ_nodes_OD(day, hour, count):
 
-    ### 1. FILTERING
+def TAZ_graph_nodes(taz_nodes_dict, node_osmid2graphid_dict, taz_ids):
+    ### Flat array of the graph node IDs of the TAZs in taz_ids: the nodes of taz_ids[i] are taz_node_ids[taz_offsets[i]:taz_offsets[i+1]]
+    taz_node_lists = [[node_osmid2graphid_dict[n] for n in taz_nodes_dict.get(str(taz), [])] for taz in taz_ids]
+    taz_offsets = np.zeros(len(taz_ids)+1, dtype=np.int64)
+    np.cumsum([len(nodes) for nodes in taz_node_lists], out=taz_offsets[1:])
+    taz_node_ids = np.fromiter((n for nodes in taz_node_lists for n in nodes), dtype=np.int64, count=taz_offsets[-1])
+    return taz_offsets, taz_node_ids
+
+def sample_nodal_OD(rng, OD_index, taz_count, taz_offsets, taz_node_ids):
+    ### Sample one origin node and one destination node for each agent, uniformly among the nodes of its origin and destination TAZ
+    ### OD_index is the flat OD matrix index of each agent's TAZ pair: O = value//taz_count, D = value%taz_count
+    ### Return the graph node IDs of the unique nodal OD pairs and the number of agents of each
+    taz_O, taz_D = OD_index // taz_count, OD_index % taz_count
+    taz_sizes = np.diff(taz_offsets)
+    has_nodes = (taz_sizes[taz_O] > 0) & (taz_sizes[taz_D] > 0)
+    if not np.all(has_nodes):
+        print('{} agents dropped, their TAZ has no nodes'.format(np.count_nonzero(~has_nodes)))
+        taz_O, taz_D = taz_O[has_nodes], taz_D[has_nodes]
+    nodes_O = taz_node_ids[taz_offsets[taz_O] + rng.integers(0, taz_sizes[taz_O])]
+    nodes_D = taz_node_ids[taz_offsets[taz_D] + rng.integers(0, taz_sizes[taz_D])]
+    ### Aggregate the agents by nodal OD pair on packed 64-bit keys (graph node IDs are below 2**32)
+    nodal_keys, flow = np.unique((nodes_O << 32) | nodes_D, return_counts=True)
+    return nodal_keys >> 32, nodal_keys & 0xffffffff, flow
+
+def load_OD_inputs(network_folder=absolute_path+'/../data_repo/data/sf'):
+    ### Load everything the OD generation needs, once for all time slices
     ### Input 1: pickups and dropoffs by TAZ from TNC study
     ### [{'taz':1, 'day':1, 'hour':10, 'pickups': 80, 'dropoffs': 100}, ...]
     ### Monday is 0 -- Sunday is 6. Hour is from 3am-26am(2am next day)
+    ### Pivoted to pickups[(day, hour)] and dropoffs[(day, hour)], arrays over the TAZs in taz_ids (0 if a TAZ is missing in a slice)
     OD_df = pd.read_csv(absolute_path+'/TNC_pickups_dropoffs.csv')
-    hour_OD_df = OD_df[(OD_df['day_of_week']==day) & (OD_df['hour']==hour)]
+    taz_ids = np.sort(OD_df['taz'].unique()) ### TAZ of each OD matrix row and column
+    pickups = OD_df.pivot_table(index=['day_of_week', 'hour'], columns='taz', values='pickups', aggfunc='sum', fill_value=0).reindex(columns=taz_ids, fill_value=0)
+    dropoffs = OD_df.pivot_table(index=['day_of_week', 'hour'], columns='taz', values='dropoffs', aggfunc='sum', fill_value=0).reindex(columns=taz_ids, fill_value=0)
+
+    ### Input 2: nodes of each TAZ, as graph node IDs
+    taz_nodes_dict = json.load(open(absolute_path+'/output/taz_nodes.json'))
+    node_osmid2graphid_dict = json.load(open(network_folder+'/node_osmid2graphid.json'))
+    taz_offsets, taz_node_ids = TAZ_graph_nodes(taz_nodes_dict, node_osmid2graphid_dict, taz_ids)
+
+    return {
+        'taz_ids': taz_ids,
+        'pickups': {k: v.values.astype(np.float64) for k, v in pickups.iterrows()},
+        'dropoffs': {k: v.values.astype(np.float64) for k, v in dropoffs.iterrows()},
+        'taz_offsets': taz_offsets, 'taz_node_ids': taz_node_ids}
+
+def slice_seed(seed, day, hour):
+    ### Seed of one time slice: the same (seed, day, hour) gives the same OD, whatever the order or the process the slices run in
+    return None if seed is None else [seed, day, hour]
+
+def slice_targets(OD_inputs, slices):
+    ### Row sums (pickups) and column sums (dropoffs) of the OD matrices of a list of (day, hour) slices, as (slices x TAZ) arrays
+    target_O = np.array([OD_inputs['pickups'][(day, hour)] for (day, hour) in slices]).reshape(len(slices), -1)
+    target_D = np.array([OD_inputs['dropoffs'][(day, hour)] for (day, hour) in slices]).reshape(len(slices), -1)
+    return target_O, target_D
 
-    ### 2. BALANCING
-    ### Get row sums and column sums
-    target_O = hour_OD_df.sort_values(by=['taz'])['pickups']
-    target_D = hour_OD_df.sort_values(by=['taz'])['dropoffs']
-    print('sum of target_O, target_D', sum(target_O), sum(target_D))
+def hour_nodal_OD(OD_inputs, day, hour, count, seed=None, OD_matrix=None):
+    ### Sample count agents from the balanced TAZ-level OD matrix of one time slice, return the nodal OD table as (O, D, flow) arrays
+    ### OD_matrix: the balanced matrix, e.g., one slice of the output of balance_OD for many slices; balanced here if not given
+    rng = np.random.default_rng(slice_seed(seed, day, hour))
 
+    ### 1. FILTERING and 2. BALANCING
     ### Get OD matrix elements constrained by row sums and column sums
-    OD_matrix = np.ones((len(target_O), len(target_D)))
-    errors_list = []
-    for i in range(20):
-        OD_matrix, errors = OD_iterations(OD_matrix, np.array(target_O), np.array(target_D))
-        errors_list.append(errors)
-        print('errors at iteration {}: {}'.format(i, errors))
-    print('sum of OD matrix elements', np.sum(OD_matrix), 'max', np.max(OD_matrix), 'min', np.min(OD_matrix), 'trace', np.trace(OD_matrix))
+    ### With a sparse seed (OD_inputs['seed_matrix']), the matrix is balanced and sampled in CSR form
+    if OD_matrix is None:
+        target_O, target_D = slice_targets(OD_inputs, [(day, hour)])
+        print('DY{}_HR{}: sum of target_O, target_D'.format(day, hour), np.sum(target_O), np.sum(target_D))
+        if OD_inputs.get('seed_matrix') is not None:
+            OD_matrix, iterations, error = balance_OD_sparse(OD_inputs['seed_matrix'], target_O[0], target_D[0])
+        else:
+            OD_matrices, iterations, errors = balance_OD(target_O, target_D)
+            OD_matrix, iterations, error = OD_matrices[0], iterations[0], errors[0]
+        print('DY{}_HR{}: relative error {} after {} iterations'.format(day, hour, error, iterations))
+    taz_count = len(OD_inputs['taz_ids'])
+    print('sum of OD matrix elements', OD_matrix.sum(), 'max', OD_matrix.max(), 'trace', OD_matrix.diagonal().sum())
     ### As we are going to ignore inter-TAZ trips (assuming they are not by car, setting diagonal elements to zero), the trace of the OD matrix should not be too big compared to the total sum of the matrix elements
-    # print(target_O)
-    # np.savetxt('tmp2.txt', OD_matrix, fmt='%.1f', newline='\n')
-    # sys.exit(0)
 
     ### 3. TAZ-level OD pairs
     ### OD_matrix element represent the probability (float). Need to sample pairs based on the probability
-    OD_keys = list(range(len(target_O)*len(target_D)))   ### O = value//len(target_O), D = value % len(target_O)
-    np.fill_diagonal(OD_matrix, 0) ### Set inter-TAZ trip probability to 0
-    OD_probs = OD_matrix.flatten()
-    print('sum of OD_prob elements', np.sum(OD_probs), 'max', np.max(OD_probs), 'min', np.min(OD_probs))
-    OD_probs /= np.sum(OD_probs)
-    print('sum of OD matrix elements', np.sum(OD_probs), 'max', np.max(OD_probs), 'min', np.min(OD_probs))
-    OD_list = np.random.choice(OD_keys, count, replace=True, p=OD_probs)
-    OD_counter = Counter(OD_list) ### get dictionary of list item count
+    ### OD_list holds the flat matrix index of each agent's TAZ pair: O = index//taz_count, D = index%taz_count
+    if scipy.sparse.issparse(OD_matrix):
+        ### Sample the stored cells by inverting their cumulative sum, O(cells + count log cells) for any number of TAZs
+        OD_coo = OD_matrix.tocoo()
+        off_diagonal = (OD_coo.row != OD_coo.col) & (OD_coo.data > 0) ### Set inter-TAZ trip probability to 0
+        cell_O, cell_D = OD_coo.row[off_diagonal].astype(np.int64), OD_coo.col[off_diagonal].astype(np.int64)
+        cell_cumsum = np.cumsum(OD_coo.data[off_diagonal])
+        cells = np.minimum(np.searchsorted(cell_cumsum, rng.random(count)*cell_cumsum[-1], side='right'), len(cell_cumsum)-1)
+        OD_list = cell_O[cells]*taz_count + cell_D[cells]
+    else:
+        OD_matrix = np.array(OD_matrix, dtype=np.float64)
+        np.fill_diagonal(OD_matrix, 0) ### Set inter-TAZ trip probability to 0
+        OD_probs = OD_matrix.flatten()
+        OD_probs /= np.sum(OD_probs)
+        OD_list = rng.choice(len(OD_probs), count, replace=True, p=OD_probs)
 
     ### 4. Nodal-level OD pairs
-    ### Now sample the nodes for each TAZ level OD pair
-    taz_nodes_dict = json.load(open(absolute_path+'/output/taz_nodes.json'))
-    node_osmid2graphid_dict = json.load(open(absolute_path+'/../data_repo/data/sf/node_osmid2graphid.json'))
-    nodal_OD = []
-    for k, v in OD_counter.items():
-        taz_O = k//len(target_O)+1 ### TAZ index starts from 1; convert from matrix element index to matrix row and column
-        taz_D = k%len(target_O)+1
-        
-        ### use the nodes from the next TAZ if there is no nodes in the current TAZ
-        ### Scenario 1: TAZ=741. It is in downtown, with many pickups and dropoffs. However, all the nodes are on the boundary (no node in TAZ=741). Then we use the nodes from nearby TAZs.
-        ### Scenario 2: TAZ=384, 385. There is no nodes in these TAZs because they are small islands. There should be no OD pairs sampled from these TAZs either.
-        if len(taz_nodes_dict[str(taz_O)])==0: taz_O += 1
-        if len(taz_nodes_dict[str(taz_D)])==0: taz_D += 1
+    ### Now sample the nodes for each TAZ level OD pair, from per-TAZ arrays of graph node IDs
+    ### Every TAZ has nodes (see TAZ_nodes): TAZ=741 in downtown has all its nodes on the boundary, so it uses the nodes on or near the boundary
+    ### TAZ=384, 385 are small islands with the nearest node on the mainland, but there are no pickups or dropoffs to sample from them
+    return sample_nodal_OD(rng, OD_list, taz_count, OD_inputs['taz_offsets'], OD_inputs['taz_node_ids'])
 
-        nodal_OD_pairs = random.choices(list(itertools.product(taz_nodes_dict[str(taz_O)], taz_nodes_dict[str(taz_D)])), k=v)
-        nodal_OD_counter = Counter(nodal_OD_pairs)
+def write_hour_OD(day, hour, count, nodal_OD, csv_output=True, binary_output=True):
+    nodal_O, nodal_D, nodal_flow = nodal_OD
+    if csv_output:
+        nodal_OD_df = pd.DataFrame({'O': nodal_O, 'D': nodal_D, 'flow': nodal_flow})
+        nodal_OD_df.to_csv(absolute_path+'/output/SF_graph_DY{}_HR{}_OD_{}.csv'.format(day, hour, count))
+    if binary_output:
+        ### Binary columnar format (int32 O, int32 D, float32 flow, sorted by O, with an origin offset index) for memory-mapped loading by the ABM
+        write_od_table(absolute_path+'/output/SF_graph_DY{}_HR{}_OD_{}'.format(day, hour, count), nodal_O, nodal_D, nodal_flow)
 
-        for nodal_k, nodal_v in nodal_OD_counter.items():
-            nodal_OD.append([node_osmid2graphid_dict[nodal_k[0]], node_osmid2graphid_dict[nodal_k[1]], nodal_v])
+def TAZ_nodes_OD(day, hour, count, csv_output=True, binary_output=True, seed=None, network_folder=absolute_path+'/../data_repo/data/sf'):
+    ### OD table of one time slice; use batch_OD for many slices, which loads the inputs only once
+    ### seed: if given, the sampling is reproducible for the same (seed, day, hour)
+    OD_inputs = load_OD_inputs(network_folder)
+    write_hour_OD(day, hour, count, hour_nodal_OD(OD_inputs, day, hour, count, seed), csv_output, binary_output)
 
+def init_worker(inputs):
+    ### Keep the inputs loaded by the parent in each worker process, so they are sent once per worker and not once per slice
+    global OD_inputs
+    OD_inputs = inputs
 
-    nodal_OD_df = pd.DataFrame(nodal_OD, columns=['O', 'D', 'flow'])
-    print(nodal_OD_df.head())
+def batch_OD_slice(task):
+    day, hour, count, seed, OD_matrix, csv_output, binary_output = task
+    write_hour_OD(day, hour, count, hour_nodal_OD(OD_inputs, day, hour, count, seed, OD_matrix), csv_output, binary_output)
+    return day, hour
 
-    nodal_OD_df.to_csv(absolute_path+'/output/SF_graph_DY{}_HR{}_OD_{}.csv'.format(day, hour, count))
+def batch_OD(days, hours, count, seed=0, processes=1, csv_output=True, binary_output=True, network_folder=absolute_path+'/../data_repo/data/sf',
+        balance_slices=24, tolerance=1e-6, dtype=np.float64, seed_matrix=None, slices=None):
+    ### OD tables of all (day, hour) slices: the inputs are loaded once, and the slices run in a pool of processes if processes > 1
+    ### slices: a list of (day, hour) to generate instead of all days x hours, e.g., only the slices that are out of date
+    ### The OD matrices of balance_slices slices at a time are balanced together (balance_OD), which bounds the memory of the stacked array
+    ### seed_matrix: a sparse seed (see sparse_seed); each slice is then balanced on its nonzero cells only (balance_OD_sparse)
+    ### Each slice has its own seed (slice_seed), so the result does not depend on processes or balance_slices
+    inputs = load_OD_inputs(network_folder)
+    inputs['seed_matrix'] = seed_matrix
+    slices = [(day, hour) for day in days for hour in hours] if slices is None else list(slices)
+    pool = Pool(processes, initializer=init_worker, initargs=(inputs,)) if processes > 1 else None
+    if pool is None: init_worker(inputs)
+    try:
+        for chunk_start in range(0, len(slices), balance_slices):
+            chunk = slices[chunk_start:chunk_start+balance_slices]
+            if seed_matrix is not None:
+                target_O, target_D = slice_targets(inputs, chunk)
+                OD_matrices, iterations, errors = zip(*[balance_OD_sparse(seed_matrix, slice_O, slice_D, tolerance=tolerance) for (slice_O, slice_D) in zip(target_O, target_D)])
+            else:
+                OD_matrices, iterations, errors = balance_OD(*slice_targets(inputs, chunk), tolerance=tolerance, dtype=dtype)
+            for (day, hour), slice_iterations, slice_error in zip(chunk, iterations, errors):
+                print('DY{}_HR{}: relative error {} after {} iterations'.format(day, hour, slice_error, slice_iterations))
+            tasks = [(day, hour, count, seed, OD_matrix, csv_output, binary_output) for ((day, hour), OD_matrix) in zip(chunk, OD_matrices)]
+            if pool is not None:
+                for day, hour in pool.imap_unordered(batch_OD_slice, tasks):
+                    print('DY{}_HR{} done'.format(day, hour))
+            else:
+                for task in tasks:
+                    batch_OD_slice(task)
+            del OD_matrices, tasks
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 if __name__ == '__main__':
-    TAZ_nodes()
-    #sys.exit(0)
+    parser = argparse.ArgumentParser(description='Generate the hourly nodal OD tables')
+    ### Monday is 0 -- Sunday is 6. Hour is from 3am-26am(2am next day)
+    ### Two typical days, 1 for Tuesday (weekday) and 6 for Sunday (weekend); --week for all 7 x 24 = 168 slices
+    parser.add_argument('--days', type=int, nargs='+', default=[1], help='days of week, Monday is 0')
+    parser.add_argument('--hours', type=int, nargs='+', default=[9, 10], help='hours, from 3 to 26')
+    parser.add_argument('--week', action='store_true', help='all days and hours of the week')
+    parser.add_argument('--count', type=int, default=50000, help='number of OD pairs sampled per hour')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sampling, combined with the day and hour of each slice')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes generating the slices')
+    parser.add_argument('--skip-taz-nodes', action='store_true', help='reuse output/taz_nodes.json')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='relative error of the column sums at which the balancing of a slice stops')
+    parser.add_argument('--float32', action='store_true', help='balance in single precision, to halve the memory')
+    parser.add_argument('--sparse-distance', type=float, default=None, help='sparse mode: only the TAZ pairs within this centroid distance (km) have trips')
+    parser.add_argument('--sparse-prior', default=None, help='sparse mode: seed the OD matrix with this scipy.sparse .npz matrix')
+    args = parser.parse_args()
 
-    for day_of_week in [1]: ### Two typical days, 1 for Tuesday (weekday) and 6 for Sunday (weekend)
-        for hour in range(9,11):#[3]: ### 24 hour-slices per day
-            ### Monday is 0 -- Sunday is 6. Hour is from 3am-26am(2am next day)
-            TAZ_nodes_OD(day_of_week, hour, 50000)
\ No newline at end of file
+    if not args.skip_taz_nodes:
+        TAZ_nodes()
+    days, hours = (range(7), range(3, 27)) if args.week else (args.days, args.hours)
+    seed_matrix = None
+    if (args.sparse_distance is not None) or (args.sparse_prior is not None):
+        seed_matrix = sparse_seed(np.sort(pd.read_csv(absolute_path+'/TNC_pickups_dropoffs.csv', usecols=['taz'])['taz'].unique()), args.sparse_distance, args.sparse_prior)
+        print('sparse seed: {} of {} TAZ pairs'.format(seed_matrix.nnz, seed_matrix.shape[0]*seed_matrix.shape[1]))
+    batch_OD(days, hours, args.count, seed=args.seed, processes=args.processes, tolerance=args.tolerance, dtype=np.float32 if args.float32 else np.float64, seed_matrix=seed_matrix)
@@ -0,0 +1,32 @@
+### Link performance function and traffic assignment steps used by the ABM driver
+### All functions work on arrays indexed by edge ID on graph
+import numpy as np
+
+def bpr(fft, capacity, volume):
+    ### Link travel time at the given volume, BPR and (colak, 2015)
+    ### According to (Colak, 2015), for SF, even vol=0, t=1.2*fft, maybe traffic light? 1.2 is f_p - k_bay
+    return fft*(1.2+0.78*(volume/capacity)**4)
+
+def relative_gap(travel_time, volume, aon_volume):
+    ### Relative gap of the current assignment: (total travel time - total travel time on the current shortest paths) / total travel time
+    ### aon_volume is the all-or-nothing assignment on travel_time, i.e., what the travel time would be if everyone took the current shortest paths
+    total_travel_time = np.dot(travel_time, volume)
+    if total_travel_time == 0: return 0
+    return (total_travel_time - np.dot(travel_time, aon_volume)) / total_travel_time
+
+def msa_step_size(iteration):
+    ### Method of successive averages: the n-th all-or-nothing assignment gets weight 1/(n+1)
+    return 1/(iteration+1)
+
+def frank_wolfe_step_size(fft, capacity, volume, aon_volume, bisection_iterations=30):
+    ### Frank-Wolfe line search: the step size in [0, 1] along (aon_volume - volume) that minimizes the Beckmann objective
+    ### The derivative of the objective along the direction is sum(direction * bpr(volume + step*direction)), which increases with step
+    direction = aon_volume - volume
+    derivative = lambda step: np.dot(direction, bpr(fft, capacity, volume + step*direction))
+    if derivative(1) <= 0: return 1
+    lower, upper = 0, 1
+    for i in range(bisection_iterations):
+        step = (lower+upper)/2
+        if derivative(step) > 0: upper = step
+        else: lower = step
+    return (lower+upper)/2
@@ -0,0 +1,60 @@
+### Checkpoints of the simulation state between hours, so that a long run can be split across chained short jobs (e.g., SLURM jobs with a short walltime)
+### After each (day, hour) the driver saves in folder/DY{day}_HR{hour}/:
+###  * volume.npy and travel_time.npy: the link volumes and BPR travel times of the hour, indexed by edge ID on graph;
+###    the travel times are the link weights of the next hour
+###  * rng.json: the state of the random number generator after the hour
+### folder/checkpoint.json lists the completed slices in order. It is replaced last, so a job killed while saving resumes from the previous slice.
+### When the results of the hours are written in the background (uploader.py), the driver saves the checkpoint of an hour
+### only once its results are written and uploaded, so that a resumed run never skips an hour without results.
+import json
+import os
+import shutil
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+def slice_folder(folder, day, hour):
+    return os.path.join(folder, 'DY{}_HR{}'.format(day, hour))
+
+def read_manifest(folder):
+    manifest_file = os.path.join(folder, 'checkpoint.json')
+    if not os.path.isfile(manifest_file):
+        return {'version': CHECKPOINT_VERSION, 'completed': []}
+    manifest = json.load(open(manifest_file))
+    if manifest['version'] != CHECKPOINT_VERSION:
+        raise ValueError('checkpoint {} has version {}, expected {}'.format(folder, manifest['version'], CHECKPOINT_VERSION))
+    return manifest
+
+def save_checkpoint(folder, day, hour, volume_array, t_new, rng_state):
+    ### Save the state after the slice (day, hour) and mark it as completed
+    ### rng_state: rng.bit_generator.state right after the slice, as the generator may have moved on since
+    target = slice_folder(folder, day, hour)
+    tmp_target = target + '.tmp'
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    os.makedirs(tmp_target)
+    np.save(os.path.join(tmp_target, 'volume.npy'), np.asarray(volume_array, dtype=np.float64))
+    np.save(os.path.join(tmp_target, 'travel_time.npy'), np.asarray(t_new, dtype=np.float64))
+    with open(os.path.join(tmp_target, 'rng.json'), 'w') as outfile:
+        json.dump(rng_state, outfile)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp_target, target)
+
+    manifest = read_manifest(folder)
+    manifest['completed'] = [s for s in manifest['completed'] if s != [day, hour]] + [[day, hour]]
+    with open(os.path.join(folder, 'checkpoint.json.tmp'), 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    os.replace(os.path.join(folder, 'checkpoint.json.tmp'), os.path.join(folder, 'checkpoint.json'))
+
+def resume_point(folder, slices):
+    ### Number of slices at the start of slices (a list of (day, hour)) that are completed in the checkpoint folder
+    completed = {tuple(s) for s in read_manifest(folder)['completed']}
+    done = 0
+    while done < len(slices) and tuple(slices[done]) in completed:
+        done += 1
+    return done
+
+def load_checkpoint(folder, day, hour, rng):
+    ### Restore the random number generator of the driver and return the link volumes and travel times of the slice (day, hour)
+    source = slice_folder(folder, day, hour)
+    rng.bit_generator.state = json.load(open(os.path.join(source, 'rng.json')))
+    return np.load(os.path.join(source, 'volume.npy')), np.load(os.path.join(source, 'travel_time.npy'))
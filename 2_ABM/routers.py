@@ -0,0 +1,225 @@
+### Shortest path routing engines behind one interface, so that the ABM driver does not depend on a particular library
+### Every router is built from the CSR topology (see utilities/csr_graph.py) and answers
+###     route_batch(origins, dest_lists, weights) --> for each origin, a list of edge ID arrays, one per destination (empty if unreachable)
+###     load_batch(origins, dest_lists, flow_lists, weights) --> flat arrays of edge IDs and their flows, and the number of reachable destinations
+### load_batch keeps one shortest path tree per origin, as an array of the tree edge into each node, and pushes the destination flows
+### up the tree level by level, so no path is ever built as a list
+### Routers convert the weights into their own structure only when they are given a different array; after changing the weights in place, call update_weights()
+import os
+import sys
+import tempfile
+import warnings
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.io
+
+class Router(object):
+
+    def __init__(self, indptr, indices, edge_ids, sources_per_call=32):
+        self.vcount = len(indptr)-1
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int32)
+        self.edge_ids = np.array(edge_ids, dtype=np.int32)
+        self.sources = np.repeat(np.arange(self.vcount, dtype=np.int32), np.diff(self.indptr)) ### source node of each CSR position
+        self.edge_sources = np.empty(len(self.edge_ids), dtype=np.int32) ### source node of each edge ID on graph
+        self.edge_sources[self.edge_ids] = self.sources
+        self.sources_per_call = sources_per_call ### bounds the (sources x nodes) arrays of one multi-source search
+        self.weights = None
+
+        ### Sorted (source, target) keys to find the edge ID between two nodes
+        edge_keys = self.sources.astype(np.int64)*self.vcount + self.indices
+        key_order = np.argsort(edge_keys)
+        self.edge_keys = edge_keys[key_order]
+        self.edge_key_ids = self.edge_ids[key_order]
+
+    def edges_between(self, from_nodes, to_nodes):
+        ### Edge IDs on graph of the edges from_nodes[i] --> to_nodes[i]
+        keys = np.asarray(from_nodes, dtype=np.int64)*self.vcount + np.asarray(to_nodes, dtype=np.int64)
+        return self.edge_key_ids[np.searchsorted(self.edge_keys, keys)]
+
+    def update_weights(self, weights):
+        ### Load the link weights (indexed by edge ID on graph) into the routing engine
+        self.weights = weights
+
+    def route_batch(self, origins, dest_lists, weights):
+        if weights is not self.weights:
+            self.update_weights(weights)
+        return [self.route_origin(origin, dest_list) for (origin, dest_list) in zip(origins, dest_lists)]
+
+    def load_batch(self, origins, dest_lists, flow_lists, weights):
+        if weights is not self.weights:
+            self.update_weights(weights)
+        edge_IDs, edge_flows, destination_count = [np.empty(0, dtype=np.int32)], [np.empty(0)], 0
+        for parent_edge, dest_list, flow_list in zip(self.shortest_path_trees(origins), dest_lists, flow_lists):
+            tree_edges, tree_flows = self.load_tree(parent_edge, np.asarray(dest_list), np.asarray(flow_list, dtype=np.float64))
+            edge_IDs.append(tree_edges)
+            edge_flows.append(tree_flows)
+            destination_count += np.count_nonzero(parent_edge[dest_list] >= 0)
+        return np.concatenate(edge_IDs), np.concatenate(edge_flows), destination_count
+
+    def load_tree(self, parent_edge, dest_list, flow_list):
+        ### Flow on each tree edge = total flow of the destinations below it
+        ### parent_edge[v] is the edge ID of the tree edge into node v, -1 for the origin and for unreachable nodes
+        ### Every node adds its accumulated flow to its parent, deepest nodes first, i.e., in reverse topological order of the tree
+        in_tree = parent_edge >= 0
+        parent = np.arange(self.vcount)
+        parent[in_tree] = self.edge_sources[parent_edge[in_tree]]
+
+        ### Depth of each node in the tree by pointer jumping: depth[v] is the number of edges from v up to ancestor[v]
+        depth = in_tree.astype(np.int32)
+        ancestor = parent.copy()
+        while np.any(ancestor != ancestor[ancestor]):
+            depth += depth[ancestor]
+            ancestor = ancestor[ancestor]
+
+        node_flow = np.bincount(dest_list, weights=flow_list, minlength=self.vcount)
+        nodes = np.flatnonzero(in_tree)
+        nodes = nodes[np.argsort(-depth[nodes], kind='stable')]
+        level_bounds = np.r_[0, np.flatnonzero(np.diff(depth[nodes])) + 1, len(nodes)]
+        for level_start, level_end in zip(level_bounds[:-1], level_bounds[1:]):
+            level_nodes = nodes[level_start:level_end]
+            np.add.at(node_flow, parent[level_nodes], node_flow[level_nodes])
+
+        loaded = nodes[node_flow[nodes] > 0]
+        return parent_edge[loaded].astype(np.int32), node_flow[loaded]
+
+    def tree_from_distances(self, distance, weights):
+        ### Shortest path tree from the distances of all nodes to the origin: the tree edge into v is an edge u --> v with distance[u] + weight == distance[v]
+        ### Weights are positive, so a tight edge always comes from a node closer to the origin and the result has no cycles
+        with np.errstate(invalid='ignore'):
+            slack = distance[self.sources] + weights[self.edge_ids] - distance[self.indices]
+            tight = np.flatnonzero(slack <= 1e-9*np.maximum(1, distance[self.indices]))
+        parent_edge = np.full(self.vcount, -1, dtype=np.int32)
+        parent_edge[self.indices[tight]] = self.edge_ids[tight]
+        return parent_edge
+
+
+class IgraphRouter(Router):
+    ### python-igraph, one get_shortest_paths call (one Dijkstra) per origin
+
+    def __init__(self, indptr, indices, edge_ids):
+        super(IgraphRouter, self).__init__(indptr, indices, edge_ids)
+        import igraph
+        ### edges in the original edge ID order, so that edge IDs returned by igraph are edge IDs on graph
+        edgelist = np.empty((len(self.edge_ids), 2), dtype=np.int32)
+        edgelist[self.edge_ids, 0] = self.sources
+        edgelist[self.edge_ids, 1] = self.indices
+        self.g = igraph.Graph(n=self.vcount, edges=edgelist.tolist(), directed=True)
+
+    def update_weights(self, weights):
+        self.weights = weights
+        self.g.es['weight'] = np.asarray(weights).tolist()
+
+    def shortest_path_trees(self, origins):
+        ### The tree edges are recovered from the distances of each origin
+        ### igraph returns distances as nested Python lists (tens of bytes per float), so they are asked for one source at a time
+        ### and converted to numpy at once: memory stays O(V), while sources_per_call sources per call would hold sources_per_call x V floats
+        weights = np.asarray(self.weights, dtype=np.float64)
+        for origin in origins:
+            distance = np.array(self.g.distances(source=int(origin), weights='weight')[0], dtype=np.float64)
+            yield self.tree_from_distances(distance, weights)
+
+    def route_origin(self, origin, dest_list):
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message="Couldn't reach some vertices at structural_properties")
+            path_collection = self.g.get_shortest_paths(int(origin), np.asarray(dest_list).tolist(), weights='weight', output='epath')
+        return [np.array(path, dtype=np.int32) for path in path_collection]
+
+
+class ScipyRouter(Router):
+    ### scipy.sparse.csgraph.dijkstra, many sources per call; no library outside numpy/scipy needed
+
+    def update_weights(self, weights):
+        self.weights = weights
+        self.matrix = scipy.sparse.csr_matrix((np.asarray(weights, dtype=np.float64)[self.edge_ids], self.indices, self.indptr), shape=(self.vcount, self.vcount))
+
+    def shortest_path_trees(self, origins):
+        ### The predecessor node of each node gives the tree edge into it
+        for batch_start in range(0, len(origins), self.sources_per_call):
+            batch_origins = np.asarray(origins[batch_start:batch_start+self.sources_per_call], dtype=np.int32)
+            predecessors = scipy.sparse.csgraph.dijkstra(self.matrix, directed=True, indices=batch_origins, return_predecessors=True)[1]
+            for predecessor in predecessors:
+                parent_edge = np.full(self.vcount, -1, dtype=np.int32)
+                reached = np.flatnonzero(predecessor >= 0)
+                parent_edge[reached] = self.edges_between(predecessor[reached], reached)
+                yield parent_edge
+
+    def route_batch(self, origins, dest_lists, weights):
+        if weights is not self.weights:
+            self.update_weights(weights)
+        results = []
+        for batch_start in range(0, len(origins), self.sources_per_call):
+            batch_origins = np.asarray(origins[batch_start:batch_start+self.sources_per_call], dtype=np.int32)
+            distances, predecessors = scipy.sparse.csgraph.dijkstra(self.matrix, directed=True, indices=batch_origins, return_predecessors=True)
+            for i, dest_list in enumerate(dest_lists[batch_start:batch_start+self.sources_per_call]):
+                results.append(self.unwind(predecessors[i], batch_origins[i], np.asarray(dest_list, dtype=np.int32)))
+        return results
+
+    def unwind(self, predecessor, origin, dest_list):
+        ### Walk back from all destinations at once, one edge per destination per step, until every walk reaches the origin
+        dest_index = np.flatnonzero((predecessor[dest_list] >= 0) & (dest_list != origin)) ### reachable destinations
+        current = dest_list[dest_index]
+        path_dest, path_edges = [], []
+        while len(current) > 0:
+            previous = predecessor[current]
+            path_dest.append(dest_index)
+            path_edges.append(self.edges_between(previous, current))
+            walking = previous != origin
+            dest_index, current = dest_index[walking], previous[walking]
+        if len(path_dest) == 0:
+            return [np.empty(0, dtype=np.int32) for d in dest_list]
+        ### Edges were collected from the destination backwards; reverse them and split by destination
+        path_dest = np.concatenate(path_dest[::-1])
+        path_edges = np.concatenate(path_edges[::-1])
+        order = np.argsort(path_dest, kind='stable')
+        return np.split(path_edges[order], np.cumsum(np.bincount(path_dest, minlength=len(dest_list)))[:-1])
+
+
+class SpRouter(Router):
+    ### sp (https://github.com/cb-cities/sp), priority queue Dijkstra, one search per origin
+    ### sp reads its graph from a Matrix Market file and has no way to change the weights in place,
+    ### so new weights are written to a temporary file and read again
+    ### Set the environment variable SP_PATH to the folder containing the sp package if it is not installed
+
+    def __init__(self, indptr, indices, edge_ids):
+        super(SpRouter, self).__init__(indptr, indices, edge_ids)
+        if os.environ.get('SP_PATH'): sys.path.insert(0, os.environ['SP_PATH'])
+        from sp import interface
+        self.interface = interface
+
+    def update_weights(self, weights):
+        self.weights = weights
+        matrix = scipy.sparse.coo_matrix((np.asarray(weights, dtype=np.float64)[self.edge_ids], (self.sources, self.indices)), shape=(self.vcount, self.vcount))
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            scipy.io.mmwrite(tmp_folder+'/weights.mtx', matrix)
+            self.g = self.interface.readgraph(bytes(tmp_folder+'/weights.mtx', encoding='utf-8'))
+
+    def load_batch(self, origins, dest_lists, flow_lists, weights):
+        ### sp does not expose the distances or predecessors of all nodes, so the flows are loaded along the paths to each destination
+        path_collections = self.route_batch(origins, dest_lists, weights)
+        edge_IDs, edge_flows, destination_count = [np.empty(0, dtype=np.int32)], [np.empty(0)], 0
+        for path_collection, flow_list in zip(path_collections, flow_lists):
+            path_lengths = np.array([len(path) for path in path_collection], dtype=np.int32)
+            edge_IDs += path_collection
+            edge_flows.append(np.repeat(np.asarray(flow_list, dtype=np.float64), path_lengths))
+            destination_count += np.count_nonzero(path_lengths)
+        return np.concatenate(edge_IDs).astype(np.int32, copy=False), np.concatenate(edge_flows), destination_count
+
+    def route_origin(self, origin, dest_list):
+        ### sp numbers the nodes from 1
+        sp = self.g.dijkstra(int(origin)+1)
+        paths = []
+        for destin in np.asarray(dest_list).tolist():
+            if (destin == origin) or (sp.distance(destin+1) > 10e7):
+                paths.append(np.empty(0, dtype=np.int32))
+                continue
+            route = np.array(sp.route(destin+1), dtype=np.int64).reshape(-1, 2) - 1 ### [(node_1, node_2), ...]
+            paths.append(self.edges_between(route[:,0], route[:,1]))
+        return paths
+
+
+ROUTERS = {'igraph': IgraphRouter, 'scipy': ScipyRouter, 'sp': SpRouter}
+
+def make_router(name, indptr, indices, edge_ids):
+    return ROUTERS[name](indptr, indices, edge_ids)
@@ -0,0 +1,60 @@
+### Schedule the origins of a routing step on the worker processes, longest jobs first
+### The cost of an origin is estimated as factor * (1 + destination_cost * number of destinations):
+### the model counts one single-source shortest path search plus the flow loading of each destination,
+### and the factor is learnt from the time the workers took for that origin in the previous steps (CostTable),
+### e.g., for an origin on the Bay Bridge approaches whose search explores most of the network.
+### The origins are then cut into chunks in decreasing order of cost, with chunk sizes shrinking as the work left gets smaller
+### (guided self-scheduling): the expensive origins start first, and the last chunks are small, so the workers finish close together.
+import numpy as np
+
+destination_cost = 0.01 ### estimated cost of loading the flow of one destination, relative to one single-source shortest path search
+
+def model_cost(destination_counts):
+    ### Cost in single-source shortest path searches, 0 for an origin without destinations
+    destination_counts = np.asarray(destination_counts)
+    return (destination_counts > 0) + destination_cost * destination_counts
+
+class CostTable(object):
+    ### Measured cost factor of each origin (graph node ID), NaN until it is measured
+    ### The factors are in seconds per search, so estimates mix measured and unmeasured origins on the same scale
+    def __init__(self, vcount):
+        self.factor = np.full(vcount, np.nan)
+
+    def default_factor(self):
+        ### Factor of the origins not measured yet: the median of the measured ones, or 1 (i.e., cost in searches) before the first step
+        measured = self.factor[~np.isnan(self.factor)]
+        return float(np.median(measured)) if len(measured) > 0 else 1.0
+
+    def estimate(self, origin_ids, destination_counts):
+        factor = self.factor[origin_ids]
+        return np.where(np.isnan(factor), self.default_factor(), factor) * model_cost(destination_counts)
+
+    def update(self, chunk_origin_ids, chunk_destination_counts, chunk_seconds):
+        ### Record the time of each chunk, shared among its origins in proportion to their estimated cost
+        ### The routers search many origins at once, so the time of a single origin is not measured directly
+        default = self.default_factor()
+        for origin_ids, destination_counts, seconds in zip(chunk_origin_ids, chunk_destination_counts, chunk_seconds):
+            factor = self.factor[origin_ids]
+            known_factor = np.where(np.isnan(factor), default, factor)
+            estimated = known_factor * model_cost(destination_counts)
+            if np.sum(estimated) <= 0: continue
+            self.factor[origin_ids] = np.where(estimated > 0, known_factor * seconds / np.sum(estimated), factor)
+
+def schedule_chunks(costs, process_count, min_chunk_cost=None):
+    ### Cut the origins with cost > 0 into chunks, longest first; return a list of arrays of origin positions
+    ### Each chunk takes about 1/(2*process_count) of the work left, but at least min_chunk_cost (by default 1/(16*process_count) of the total)
+    ### A single origin costlier than that is a chunk of its own
+    costs = np.asarray(costs, dtype=np.float64)
+    order = np.flatnonzero(costs > 0)
+    order = order[np.argsort(-costs[order], kind='stable')]
+    cumulative_cost = np.cumsum(costs[order])
+    total_cost = cumulative_cost[-1] if len(order) > 0 else 0
+    if min_chunk_cost is None: min_chunk_cost = total_cost / (16*process_count)
+    chunks, start = [], 0
+    while start < len(order):
+        done = cumulative_cost[start-1] if start > 0 else 0
+        target = max((total_cost - done) / (2*process_count), min_chunk_cost)
+        end = max(start+1, int(np.searchsorted(cumulative_cost, done + target, side='right')))
+        chunks.append(order[start:end])
+        start = end
+    return chunks
@@ -0,0 +1,400 @@
+### Based on https://mikecvet.wordpress.com/2010/07/02/parallel-mapreduce-in-python/
+import json
+import sys
+import argparse
+import numpy as np
+import scipy.sparse
+import scipy.stats 
+from multiprocessing import Pool 
+from itertools import repeat 
+import time 
+import os
+import logging
+import datetime
+import copy
+import functools
+import pandas as pd 
+
+from shared_graph import to_shared, from_shared, release_shared
+from routers import make_router, ROUTERS
+from assignment import bpr, relative_gap, msa_step_size, frank_wolfe_step_size
+from uploader import Uploader, make_backend
+from checkpoint import save_checkpoint, resume_point, load_checkpoint
+from scheduler import CostTable, schedule_chunks
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))+'/../utilities')
+from od_table import read_od_table, csv_to_od_table
+from csr_graph import read_csr_graph, CSR_ARRAYS
+from results_writer import LinkResults
+
+def init_worker(router_name, graph_spec, weight_spec):
+    ### Runs once in each process of the persistent pool
+    ### Map the graph topology and the link weights from shared memory, instead of inheriting the driver's globals by fork,
+    ### and build the routing engine on them
+    global router, weight_array, weight_version, weight_shm, OD_folder_open
+    csr_shms, csr_arrays = zip(*[from_shared(spec) for spec in graph_spec])
+    router = make_router(router_name, *csr_arrays)
+    for shm in csr_shms: shm.close() ### the topology is copied into the router, only the weights are re-read at every step
+    weight_shm, weight_array = from_shared(weight_spec)
+    weight_version = -1
+    OD_folder_open = None
+
+def open_OD(OD_folder):
+    ### Memory-map the binary OD table of the current step in the worker; only one table is kept open
+    global OD_folder_open, OD_table
+    if OD_folder != OD_folder_open:
+        OD_table = read_od_table(OD_folder)
+        OD_folder_open = OD_folder
+    return OD_table
+
+def map_edge_pop(task):
+    ### Find shortest path for each unique origin --> multiple destinations
+    ### One single-source shortest path tree per origin, shared by all destinations of that origin
+    ### Each task is a chunk of origins of the binary OD table (positions in its origins column), so that one IPC round trip carries many origins
+    ### Return the edge IDs and flows, the number of destinations and the routing time of the chunk, for the cost table of the scheduler
+
+    step_version, OD_folder, origin_indices, row_selection = task ### row_selection: None for all OD rows of the chunk, or a boolean mask over them, origin by origin
+
+    ### Pick up the link weights of the current step from shared memory once per step
+    global weight_version
+    if step_version != weight_version:
+        router.update_weights(weight_array)
+        weight_version = step_version
+    t0 = time.time() ### the time of the chunk itself, without the weight update
+
+    ### Slices of the memory-mapped columns, no copy until the router needs them
+    OD_table = open_OD(OD_folder)
+    offsets = OD_table['offsets']
+    origin_IDs, destin_ID_lists, traffic_flow_lists = [], [], []
+    selection_start = 0
+    for origin_index in origin_indices:
+        destin_IDs = OD_table['D'][offsets[origin_index]:offsets[origin_index+1]] ### destinations' IDs on graph nodes
+        traffic_flows = OD_table['flow'][offsets[origin_index]:offsets[origin_index+1]] ### number of travellers for each OD
+        if row_selection is not None:
+            selected = row_selection[selection_start:(selection_start+len(destin_IDs))]
+            selection_start += len(destin_IDs)
+            destin_IDs, traffic_flows = destin_IDs[selected], traffic_flows[selected]
+        if len(destin_IDs) == 0:
+            continue
+        origin_IDs.append(int(OD_table['origins'][origin_index])) ### origin's ID on graph nodes
+        destin_ID_lists.append(destin_IDs)
+        traffic_flow_lists.append(traffic_flows)
+
+    ### multiple destinations
+    ### the flows are pushed up each origin's shortest path tree, so each tree edge is returned once with the sum of the flows through it
+    ### return flat arrays of edge IDs and the flow on each of them, rather than lists of (edge, flow) tuples
+    return router.load_batch(origin_IDs, destin_ID_lists, traffic_flow_lists, weight_array) + (time.time()-t0,)
+
+def chunk_rows(offsets, origin_indices):
+    ### OD rows of a chunk of origins, origin by origin
+    sizes = offsets[origin_indices+1] - offsets[origin_indices]
+    return np.repeat(offsets[origin_indices] - np.cumsum(sizes) + sizes, sizes) + np.arange(np.sum(sizes))
+
+reduce_chunk_size = 10000000 ### number of (edge ID, flow) elements to sum in one np.bincount call
+
+def edge_tot_pop(L, day, hour):
+    ### Sum the flows of all edge IDs returned by the workers into one edge volume array
+    logger = logging.getLogger('main.one_step.edge_tot_pop')
+    t0 = time.time()
+    edge_volume = np.zeros(graph['ecount'])
+    ### edge_IDs is an array of edge IDs on graph, edge_flows is the flow on each of them
+    ### results are reduced one chunk at a time to bound the size of the concatenated arrays
+    chunk_IDs, chunk_flows, chunk_size = [], [], 0
+    for edge_IDs, edge_flows in L:
+        chunk_IDs.append(edge_IDs)
+        chunk_flows.append(edge_flows)
+        chunk_size += len(edge_IDs)
+        if chunk_size >= reduce_chunk_size:
+            edge_volume += np.bincount(np.concatenate(chunk_IDs), weights=np.concatenate(chunk_flows), minlength=graph['ecount'])
+            chunk_IDs, chunk_flows, chunk_size = [], [], 0
+    if chunk_size > 0:
+        edge_volume += np.bincount(np.concatenate(chunk_IDs), weights=np.concatenate(chunk_flows), minlength=graph['ecount'])
+    t1 = time.time()
+    logger.info('DY{}_HR{}: # edges to be updated {}, taking {} seconds'.format(day, hour, np.count_nonzero(edge_volume), t1-t0))
+
+    return edge_volume
+
+def read_OD(day, hour, args, rng):
+    ### Open the binary OD table of this time step and split its origins into chunks for the workers
+    ### Return the table folder and a list of increments, each a list of OD chunks (origin_start, origin_end, row_selection)
+    ### There is only one increment, unless args.assignment is 'incremental'
+    
+    logger = logging.getLogger('main.read_OD')
+
+    ### Read/Generate OD matrix for this time step
+    ### OD tables in the csv format are converted to the binary format once, next to the csv file
+    OD_file = args.od_file.format(day=day, hour=hour)
+    if OD_file.endswith('.csv'):
+        OD_folder = OD_file[:-len('.csv')]
+        if (not os.path.isfile(OD_folder+'/meta.json')) or (os.path.getmtime(OD_folder+'/meta.json') < os.path.getmtime(OD_file)):
+            csv_to_od_table(OD_file, OD_folder)
+    else:
+        OD_folder = OD_file
+    OD_table = read_od_table(OD_folder)
+    offsets = OD_table['offsets']
+    unique_origin = len(OD_table['origins']) if args.origins is None else min(args.origins, len(OD_table['origins']))
+    logger.info('DY{}_HR{}: # OD rows {}, # unique origins {}'.format(day, hour, offsets[unique_origin], unique_origin))
+
+    ### The origins are scheduled longest first by their estimated cost (scheduler.py)
+    ### In the MPI mode, the chunks are shared by the worker processes of all ranks
+    process_count = args.processes * (comm.Get_size() if comm is not None else 1)
+    min_chunk_cost = None if args.chunk_work is None else args.chunk_work * cost_table.default_factor()
+    origin_IDs = np.asarray(OD_table['origins'][0:unique_origin])
+    if args.assignment != 'incremental':
+        costs = cost_table.estimate(origin_IDs, np.diff(offsets[0:unique_origin+1]))
+        OD_increments = [[(origin_indices, None) for origin_indices in schedule_chunks(costs, process_count, min_chunk_cost)]]
+    else:
+        ### Incremental assignment: split the OD rows into equal-sized random increments
+        increment_IDs = rng.permutation(offsets[unique_origin]) % args.increments
+        OD_increments = []
+        for increment in range(args.increments):
+            selected = (increment_IDs == increment)
+            costs = cost_table.estimate(origin_IDs, np.add.reduceat(selected, offsets[0:unique_origin]) if unique_origin > 0 else np.zeros(0, dtype=int))
+            OD_increments.append([(origin_indices, selected[chunk_rows(offsets, origin_indices)]) for origin_indices in schedule_chunks(costs, process_count, min_chunk_cost)])
+    logger.debug('DY{}_HR{}: # chunks {}'.format(day, hour, [len(OD_chunks) for OD_chunks in OD_increments]))
+
+    return OD_folder, OD_increments
+
+def scatter_OD(OD_folder, OD_increments):
+    ### MPI mode: rank 0 deals the OD chunks of each increment to the ranks in turn, each rank routes its share on its own pool
+    size = comm.Get_size()
+    OD_folder = comm.bcast(OD_folder, root=0)
+    rank_increments = [[OD_chunks[rank::size] for OD_chunks in OD_increments] for rank in range(size)] if comm.Get_rank() == 0 else None
+    return OD_folder, comm.scatter(rank_increments, root=0)
+
+def one_step(day, hour, OD_folder, OD_chunks, pool):
+    ### One all-or-nothing routing of the OD chunks on the persistent pool
+    ### The routing uses the link weights last written to shared memory by publish_weights()
+    
+    logger = logging.getLogger('main.one_step')
+
+    ### Find shortest pathes
+    t_odsp_0 = time.time()
+    ### Each task only carries the location of its origins in the binary OD table, the workers read the rows from the memory-mapped file
+    ### The chunks are queued longest first, and each worker takes the next one as soon as it is done with the previous
+    res = list(pool.imap(map_edge_pop, [(step_version, OD_folder) + OD_chunk for OD_chunk in OD_chunks]))
+    t_odsp_1 = time.time()
+    logger.debug('shortest_path time is {}'.format(t_odsp_1 - t_odsp_0))
+
+    ### Collapse into edge total population array
+    edge_IDs, edge_flows, destination_counts, chunk_seconds = zip(*res) if res else ((), (), (), ())
+    logger.info('DY{}_HR{}: # destinations {}'.format(day, hour, sum(destination_counts)))
+    update_costs(OD_folder, OD_chunks, chunk_seconds)
+    edge_volume = edge_tot_pop(zip(edge_IDs, edge_flows), day, hour)
+    if comm is not None:
+        ### Sum the edge volumes routed by all ranks
+        comm.Allreduce(MPI.IN_PLACE, edge_volume, op=MPI.SUM)
+
+    return edge_volume
+
+def update_costs(OD_folder, OD_chunks, chunk_seconds):
+    ### Record the routing time of each chunk in the cost table, for scheduling the next steps
+    ### In the MPI mode, the times of all ranks are collected by rank 0, which schedules the chunks
+    OD_table = read_od_table(OD_folder)
+    offsets = OD_table['offsets']
+    chunk_costs = []
+    for (origin_indices, row_selection), seconds in zip(OD_chunks, chunk_seconds):
+        if row_selection is None:
+            destination_counts = offsets[origin_indices+1] - offsets[origin_indices]
+        else:
+            sizes = offsets[origin_indices+1] - offsets[origin_indices]
+            destination_counts = np.add.reduceat(row_selection, np.cumsum(sizes) - sizes) if len(sizes) > 0 else sizes
+        chunk_costs.append((np.asarray(OD_table['origins'][origin_indices]), destination_counts, seconds))
+    if comm is not None:
+        chunk_costs = comm.gather(chunk_costs, root=0)
+        if comm.Get_rank() != 0: return
+        chunk_costs = [c for rank_costs in chunk_costs for c in rank_costs]
+    if chunk_costs:
+        cost_table.update(*zip(*chunk_costs))
+        logging.getLogger('main.one_step').debug('# chunks {}, longest chunk {} seconds'.format(len(chunk_costs), max(c[2] for c in chunk_costs)))
+
+def publish_weights(weights, edges=slice(None)):
+    ### Write new link weights to shared memory for the workers, for all edges or only for the given edge IDs
+    ### Only called between routing steps, when all tasks have returned and no worker is reading them
+    ### In the MPI mode every rank calls it with weights of the same shape, and the weights of rank 0 are used by all of them
+    global step_version
+    if comm is not None:
+        weights = np.array(np.broadcast_to(weights, weight_shared[edges].shape), dtype=weight_shared.dtype)
+        comm.Bcast(weights, root=0)
+    weight_shared[edges] = weights
+    step_version += 1
+
+def assign_hour(day, hour, OD_folder, OD_increments, pool, fft_array, capacity_array, args):
+    ### Traffic assignment of one time step, returns the link volumes
+    ### 'aon': one all-or-nothing assignment on the current link weights
+    ### 'msa'/'fw': route --> BPR --> re-route until the relative gap is below args.gap,
+    ###     moving the volumes towards each new all-or-nothing assignment by the method of successive averages or by the Frank-Wolfe line search
+    ###     The first routing uses the current link weights (free flow or the previous hour), later ones the BPR travel times of the current volumes
+    ### 'incremental': starting from free flow, route one increment of the OD rows at a time,
+    ###     and update the BPR travel times of the edges it loaded before routing the next increment
+
+    logger = logging.getLogger('main.assign_hour')
+
+    if args.assignment == 'incremental':
+        publish_weights(bpr(fft_array, capacity_array, 0))
+        volume_array = np.zeros(len(fft_array))
+        for increment, OD_chunks in enumerate(OD_increments):
+            increment_volume_array = one_step(day, hour, OD_folder, OD_chunks, pool)*volume_scale
+            touched_edges = np.flatnonzero(increment_volume_array)
+            volume_array[touched_edges] += increment_volume_array[touched_edges]
+            publish_weights(bpr(fft_array[touched_edges], capacity_array[touched_edges], volume_array[touched_edges]), touched_edges)
+            logger.info('DY{}_HR{}: increment {}, # edges updated {}'.format(day, hour, increment, len(touched_edges)))
+        return volume_array
+
+    OD_chunks, = OD_increments
+    volume_array = one_step(day, hour, OD_folder, OD_chunks, pool)*volume_scale
+    if args.assignment == 'aon':
+        return volume_array
+
+    for iteration in range(1, args.max_iterations+1):
+        t_iteration = bpr(fft_array, capacity_array, volume_array)
+        publish_weights(t_iteration)
+        aon_volume_array = one_step(day, hour, OD_folder, OD_chunks, pool)*volume_scale
+
+        gap = relative_gap(t_iteration, volume_array, aon_volume_array)
+        if comm is not None: gap = comm.bcast(gap, root=0) ### all ranks stop at the same iteration
+        logger.info('DY{}_HR{}: {} iteration {}, relative gap {}'.format(day, hour, args.assignment, iteration, gap))
+        if gap < args.gap:
+            break
+
+        if args.assignment == 'msa':
+            step_size = msa_step_size(iteration)
+        else:
+            step_size = frank_wolfe_step_size(fft_array, capacity_array, volume_array, aon_volume_array)
+        volume_array = volume_array + step_size*(aon_volume_array - volume_array)
+
+    return volume_array
+
+volume_scale = 400 ### 400 is the factor to scale Uber/Lyft trip # to total car trip # in SF.
+
+comm = None ### MPI communicator of the driver ranks in the MPI mode (--mpi), None otherwise
+cost_table = None ### measured routing cost of each origin, see scheduler.py
+
+def parse_args(argv=None):
+    ### Command line options; they can also be read from a config file with one option per line, e.g., `python sf_abm_mp.py @sf_abm.cfg`
+    absolute_path = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Agent based traffic simulation with multiprocessing', fromfile_prefix_chars='@')
+    parser.add_argument('--router', choices=sorted(ROUTERS), default='igraph', help='shortest path engine: python-igraph, scipy.sparse.csgraph or sp (default: igraph)')
+    parser.add_argument('--mpi', action='store_true', help='run one driver per MPI rank (mpirun -np N), each with its own pool of --processes workers, and split the origins of each step across the ranks')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count())), help='number of worker processes (default: $SLURM_CPUS_PER_TASK or the number of CPUs)')
+    parser.add_argument('--chunk-work', type=float, default=None, help='minimum estimated work per task, in single-source shortest path searches (default: 1/16 of the work per process)')
+    parser.add_argument('--days', type=int, nargs='+', default=[1], help='days of week to simulate, Monday is 0')
+    parser.add_argument('--hours', type=int, nargs='+', default=[9], help='hours of day to simulate, from 3 to 26 (2am next day)')
+    parser.add_argument('--od-file', default=absolute_path+'/../TNC/output/SF_graph_DY{day}_HR{hour}_OD_50000', help='binary OD table folder (or .csv file) of each time step, with {day} and {hour} placeholders')
+    parser.add_argument('--graph-folder', default=absolute_path+'/../data_repo/data/sf/network_csr', help='binary CSR graph bundle written by 0_network/scripts/2_json2graph.py')
+    parser.add_argument('--assignment', choices=['aon', 'msa', 'fw', 'incremental'], default='aon', help='all-or-nothing assignment once per hour, iterate to user equilibrium with the method of successive averages or Frank-Wolfe, or load the OD rows in increments (default: aon)')
+    parser.add_argument('--increments', type=int, default=10, help='number of increments per hour for the incremental assignment (default: 10)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random number generator, e.g., for splitting the OD rows into increments (default: 0)')
+    parser.add_argument('--max-iterations', type=int, default=20, help='maximum number of equilibrium iterations per hour (default: 20)')
+    parser.add_argument('--gap', type=float, default=1e-3, help='relative gap at which the equilibrium iterations stop (default: 0.001)')
+    parser.add_argument('--origins', type=int, default=None, help='only route the first N unique origins of each OD table, for testing (default: all)')
+    parser.add_argument('--output-folder', default=None, help='write the link volumes and speeds of each hour to this folder (default: no output)')
+    parser.add_argument('--output-format', choices=['npy', 'parquet', 'geojson'], default='npy', help='.npy columns, a Parquet table or the full GeoJSON per hour; the link geometry is written once in links.geojson (default: npy)')
+    parser.add_argument('--checkpoint-dir', default=None, help='save the link volumes, travel times and random state after each hour to this folder (default: no checkpoints)')
+    parser.add_argument('--resume', action='store_true', help='skip the days and hours already completed in --checkpoint-dir and continue from the last of them')
+    parser.add_argument('--upload-to', default=None, help='also upload the output of each hour, gzipped, to s3://bucket/prefix/ or to a local folder, e.g., s3://sf-abm/test_0707/ (default: no upload)')
+    args = parser.parse_args(argv)
+    if args.upload_to is not None and args.output_folder is None:
+        parser.error('--upload-to uploads the files written to --output-folder, which is not given')
+    return args
+
+def main(args=None):
+    if args is None: args = parse_args()
+    absolute_path = os.path.dirname(os.path.abspath(__file__))
+    global comm, MPI
+    if args.mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank() if comm is not None else 0
+    ### Rank 0 reads the OD tables and writes the log, the checkpoints and the results; the other ranks only route
+    logging.basicConfig(filename=absolute_path+('/sf_abm_mp.log' if rank == 0 else '/sf_abm_mp_rank{}.log'.format(rank)), level=logging.DEBUG)
+    logger = logging.getLogger('main')
+    logger.info('{} \n\n'.format(datetime.datetime.now()))
+
+    t_start = time.time()
+
+    ### Read initial graph
+    global graph
+    graph = read_csr_graph(args.graph_folder)
+    logger.info('graph summary: {} nodes, {} edges'.format(graph['vcount'], graph['ecount']))
+    fft_array = np.array(graph['fft'], dtype=float)
+    capacity_array = np.array(graph['capacity'], dtype=float)
+    ### the free flow time should still be calibrated rather than equal to the time at speed limit, check coefficient 1.2 in bpr()
+    logger.info('max/min FFT in seconds: {}/{}'.format(np.max(fft_array), np.min(fft_array)))
+
+    ### Share the graph topology and the link weights with the workers
+    csr_shms, graph_spec = zip(*[to_shared(graph[name]) for name in CSR_ARRAYS])
+    global weight_shared, step_version, cost_table
+    weight_shm, weight_spec = to_shared(bpr(fft_array, capacity_array, 0)) ### free flow travel time
+    weight_shared = np.ndarray(weight_spec[1], dtype=weight_spec[2], buffer=weight_shm.buf)
+    step_version = 0
+    cost_table = CostTable(graph['vcount'])
+
+    rng = np.random.default_rng(args.seed)
+    ### The results of each hour are written and uploaded by a background thread, while the next hour is routed
+    uploader = None
+    if args.output_folder is not None and rank == 0:
+        backend, prefix = make_backend(args.upload_to) if args.upload_to is not None else (None, '')
+        uploader = Uploader(LinkResults(args.output_folder, graph, args.output_format), backend, prefix)
+
+    ### Define processes
+    logger.debug('number of process is {}'.format(args.processes))
+
+    ### Build one pool for all time steps
+    pool = Pool(processes=args.processes, initializer=init_worker, initargs=(args.router, graph_spec, weight_spec))
+    logger.debug('pool initialized')
+
+    ### Time slices in the order they are simulated; with --resume, start after the last one completed in the checkpoints
+    slices = [(day, hour) for day in args.days for hour in args.hours]
+    done = 0
+    if args.resume:
+        if args.checkpoint_dir is None:
+            raise ValueError('--resume needs --checkpoint-dir')
+        done = resume_point(args.checkpoint_dir, slices)
+        if done > 0:
+            volume_array, t_new = load_checkpoint(args.checkpoint_dir, *slices[done-1], rng)
+            publish_weights(t_new)
+        logger.info('resuming after {} of {} time slices'.format(done, len(slices)))
+
+    try:
+        for (day, hour) in slices[done:]:
+
+            logger.info('*************** DY{} HR{} ***************'.format(day, hour))
+
+            t0 = time.time()
+            OD_folder, OD_increments = read_OD(day, hour, args, rng) if rank == 0 else (None, None)
+            if comm is not None:
+                OD_folder, OD_increments = scatter_OD(OD_folder, OD_increments)
+            volume_array = assign_hour(day, hour, OD_folder, OD_increments, pool, fft_array, capacity_array, args)
+            t1 = time.time()
+            logger.info('DY{}_HR{}: running time {}'.format(day, hour, t1-t0))
+
+            ### Update graph
+            logger.info('DY{}_HR{}: max link volume {}'.format(day, hour, np.max(volume_array)))
+            t_new = bpr(fft_array, capacity_array, volume_array)
+
+            ### The travel times of this hour are the link weights for the next hour
+            publish_weights(t_new)
+
+            ### The hour is only marked as completed in the checkpoints once its results are written and uploaded
+            checkpoint = None
+            if args.checkpoint_dir is not None and rank == 0:
+                checkpoint = functools.partial(save_checkpoint, args.checkpoint_dir, day, hour, volume_array, t_new, rng.bit_generator.state)
+            if uploader is not None:
+                uploader.publish(day, hour, volume_array, t_new, on_done=checkpoint)
+            elif checkpoint is not None:
+                checkpoint()
+    finally:
+        ### Close the pool
+        pool.close()
+        pool.join()
+        release_shared(list(csr_shms) + [weight_shm])
+        if uploader is not None:
+            uploader.close()
+
+    t_end = time.time()
+    logger.info('total run time is {} seconds \n\n\n\n\n'.format(t_end-t_start))
+
+if __name__ == '__main__':
+    main()
+
@@ -1,6 +1,5 @@
 import cProfile
-import sf_abm_mp_igraph ### with python-igraph
-# import sf_abm_mp_qdijkstra ### with our sp implementation
+import sf_abm_mp ### choose the shortest path engine with --router, e.g., `python sf_abm_mp_profile.py --router scipy`
 
-cProfile.run('sf_abm_mp_igraph.main()', 'sf_abm_mp_profile.txt')
-# cProfile.run('sf_abm_mp_qdijkstra.main()', 'sf_abm_mp_profile.txt')
+if __name__ == '__main__': ### guard, so that worker processes started with "spawn" do not re-run the profiler
+    cProfile.run('sf_abm_mp.main()', 'sf_abm_mp_profile.txt')
@@ -0,0 +1,28 @@
+### Share the graph topology and the link weights between the ABM driver and its worker processes
+### The driver copies the CSR arrays into multiprocessing.shared_memory once; workers map them without copying,
+### so the same pool of workers can be reused for every simulated hour, under both the "fork" and "spawn" start methods.
+import numpy as np
+from multiprocessing import shared_memory
+
+def to_shared(array):
+    ### Copy an array into a new shared memory block
+    ### Return the block (the caller is responsible for close() and unlink()) and the spec to attach to it from another process
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared_array[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def from_shared(spec):
+    ### Attach to a shared memory block created by to_shared() in another process
+    ### Return the block (keep a reference to it for as long as the array is used) and the array view on it
+    name, shape, dtype = spec
+    ### Workers share the resource tracker of the driver, so the block is still removed only once, by release_shared()
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def release_shared(shm_list):
+    ### Close and remove the shared memory blocks created by the driver
+    for shm in shm_list:
+        shm.close()
+        shm.unlink()
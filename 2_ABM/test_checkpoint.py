@@ -0,0 +1,77 @@
+### A run killed after an hour is published, but before its results are uploaded, must not mark the hour as completed
+### Run with `python -m pytest 2_ABM/test_checkpoint.py`
+import os
+import subprocess
+import sys
+import textwrap
+import numpy as np
+
+absolute_path = os.path.dirname(os.path.abspath(__file__))
+
+killed_run = textwrap.dedent('''
+    import functools, os, sys, threading
+    import numpy as np
+    sys.path.insert(0, {abm!r})
+    from checkpoint import save_checkpoint
+    from uploader import Uploader
+
+    class Results(object):
+        folder = {results!r}
+        def write_hour(self, day, hour, volume_array, t_new):
+            path = os.path.join(self.folder, 'DY{{}}_HR{{}}.npy'.format(day, hour))
+            np.save(path, volume_array)
+            return path
+
+    upload_started = threading.Event()
+    class SlowBackend(object):
+        ### The upload never finishes before the job is killed
+        def put(self, path, key, content_encoding=None):
+            upload_started.set()
+            threading.Event().wait()
+
+    rng = np.random.default_rng(0)
+    uploader = Uploader(Results(), SlowBackend())
+    volume_array, t_new = np.ones(5), np.ones(5)
+    uploader.publish(1, 9, volume_array, t_new,
+        on_done=functools.partial(save_checkpoint, {checkpoints!r}, 1, 9, volume_array, t_new, rng.bit_generator.state))
+    assert upload_started.wait(60)
+    os._exit(1) ### killed during the upload, e.g., by the walltime limit
+    ''')
+
+def test_killed_before_upload(tmp_path):
+    sys.path.insert(0, absolute_path)
+    from checkpoint import resume_point
+    results, checkpoints = str(tmp_path/'results'), str(tmp_path/'checkpoints')
+    os.makedirs(results)
+    os.makedirs(checkpoints)
+    open(os.path.join(results, 'links.geojson'), 'w').close()
+    script = killed_run.format(abm=absolute_path, results=results, checkpoints=checkpoints)
+    assert subprocess.run([sys.executable, '-c', script]).returncode == 1
+    assert resume_point(checkpoints, [(1, 9), (1, 10)]) == 0
+
+def test_checkpoint_after_upload(tmp_path):
+    sys.path.insert(0, absolute_path)
+    from checkpoint import save_checkpoint, resume_point, load_checkpoint
+    from uploader import Uploader, LocalBackend
+
+    class Results(object):
+        folder = str(tmp_path)
+        def write_hour(self, day, hour, volume_array, t_new):
+            path = os.path.join(self.folder, 'DY{}_HR{}.npy'.format(day, hour))
+            np.save(path, volume_array)
+            return path
+
+    open(os.path.join(str(tmp_path), 'links.geojson'), 'w').close()
+    checkpoints = str(tmp_path/'checkpoints')
+    rng = np.random.default_rng(0)
+    rng_state = rng.bit_generator.state
+    uploader = Uploader(Results(), LocalBackend(str(tmp_path/'store')))
+    uploader.publish(1, 9, np.arange(5.0), np.ones(5), on_done=lambda: save_checkpoint(checkpoints, 1, 9, np.arange(5.0), np.ones(5), rng_state))
+    rng.random(10) ### the driver moves on to the next hour
+    uploader.close()
+    assert os.path.isfile(str(tmp_path/'store'/'DY1_HR9.npy.gz'))
+    assert resume_point(checkpoints, [(1, 9), (1, 10)]) == 1
+    resumed_rng = np.random.default_rng()
+    volume_array, t_new = load_checkpoint(checkpoints, 1, 9, resumed_rng)
+    assert np.array_equal(volume_array, np.arange(5.0))
+    assert resumed_rng.bit_generator.state == rng_state
@@ -0,0 +1,106 @@
+### Publish the results of each hour in the background, so that routing the next hour overlaps with writing and uploading this one
+### A single thread takes the hours from a bounded queue, writes them with results_writer.LinkResults, gzips the files and
+### puts them to a backend: S3 (one boto3 client for the whole run, multipart for large files) or a local folder for offline runs.
+### If the uploads fall behind, publish() blocks once max_pending hours are waiting, so memory stays bounded.
+import gzip
+import os
+import queue
+import shutil
+import threading
+
+multipart_threshold = 16 * 1024 * 1024 ### bytes, larger files are uploaded to S3 in parts
+compressed_suffixes = ('.gz', '.parquet') ### not worth compressing again
+
+class LocalBackend(object):
+    ### Stand-in for the object store: the object key is a path under folder
+    def __init__(self, folder):
+        self.folder = folder
+
+    def put(self, path, key, content_encoding=None):
+        target = os.path.join(self.folder, key + ('.gz' if content_encoding == 'gzip' else ''))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target+'.tmp')
+        os.replace(target+'.tmp', target)
+
+class S3Backend(object):
+    ### Objects in an S3 bucket, e.g., read by DeckGL; the client is created once and reused by every upload
+    def __init__(self, bucket, acl='private'):#'public-read'
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        self.bucket, self.acl = bucket, acl
+        self.client = boto3.client('s3')
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold)
+
+    def put(self, path, key, content_encoding=None):
+        extra_args = {'ACL': self.acl}
+        if content_encoding is not None: extra_args['ContentEncoding'] = content_encoding
+        self.client.upload_file(path, self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+
+def make_backend(destination):
+    ### s3://bucket/prefix/ or a local folder; return the backend and the key prefix
+    if destination.startswith('s3://'):
+        bucket, _, prefix = destination[len('s3://'):].partition('/')
+        return S3Backend(bucket), prefix
+    return LocalBackend(destination), ''
+
+class Uploader(object):
+    ### Background writer and uploader of the LinkResults of each hour
+    ### backend: None to only write the results, without uploading them
+    def __init__(self, results, backend=None, prefix='', compress=True, max_pending=2):
+        self.results, self.backend, self.prefix, self.compress = results, backend, prefix, compress
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.static_uploaded = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, day, hour, volume_array, t_new, on_done=None):
+        ### Queue an hour; the arrays must not be modified afterwards
+        ### on_done() is called by the background thread once the hour is written and uploaded, e.g., to save its checkpoint
+        self.check()
+        self.tasks.put((day, hour, volume_array, t_new, on_done))
+
+    def close(self):
+        ### Wait for the queued hours, then raise the first error of the background thread, if any
+        self.tasks.put(None)
+        self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('publishing the results failed') from self.error
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None: return
+            if self.error is not None: continue ### keep draining the queue so publish() does not block
+            try:
+                day, hour, volume_array, t_new, on_done = task
+                path = self.results.write_hour(day, hour, volume_array, t_new)
+                if not self.static_uploaded: ### the link geometry, written with the first hour
+                    self.upload(os.path.join(self.results.folder, 'links.geojson'))
+                    self.static_uploaded = True
+                self.upload(path)
+                if on_done is not None: on_done()
+            except Exception as e:
+                self.error = e
+
+    def upload(self, path):
+        ### Put a results file, or each file of a results folder, under prefix/<name>
+        if self.backend is None: return
+        if os.path.isdir(path):
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+        else:
+            files = [path]
+        for f in files:
+            key = self.prefix + os.path.relpath(f, os.path.dirname(path))
+            if self.compress and not f.endswith(compressed_suffixes):
+                with open(f, 'rb') as infile, gzip.open(f+'.gz', 'wb', compresslevel=6) as outfile:
+                    shutil.copyfileobj(infile, outfile)
+                try:
+                    self.backend.put(f+'.gz', key, content_encoding='gzip')
+                finally:
+                    os.remove(f+'.gz')
+            else:
+                self.backend.put(f, key)
@@ -0,0 +1,115 @@
+### Build the network and the OD tables of a scenario, only rebuilding the stages whose inputs or parameters changed
+### OSM download (with --bbox) --> 1_osm2json --> 2_json2graph --> (3_graph_to_mtx) --> TAZ nodes --> hourly OD tables
+### Every stage is recorded in build_cache.json (utilities/build_cache.py) with the hashes of its inputs and outputs and its parameters
+### Usage: python pipeline.py --region sf --days 1 --hours 9 10 --count 50000 --seed 0
+import argparse
+import os
+import subprocess
+import sys
+import urllib.parse
+import urllib.request
+
+absolute_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, absolute_path+'/utilities')
+from build_cache import BuildCache
+
+def download_osm(bbox, osm_file):
+    ### Download the drivable street network in bbox (south,west,north,east) from overpass, as in 0_network/README.md
+    query = 'data=[out:json][bbox:{}];way[highway];(._;>;);out;'.format(bbox)
+    request = urllib.request.Request('http://overpass-api.de/api/interpreter', data=query.encode('utf-8'), method='POST')
+    with urllib.request.urlopen(request) as response, open(osm_file, 'wb') as outfile:
+        for chunk in iter(lambda: response.read(1 << 20), b''):
+            outfile.write(chunk)
+
+def run_script(script, *script_args):
+    ### Run one of the 0_network scripts in its own folder, stop the pipeline if it fails
+    subprocess.run([sys.executable, os.path.basename(script)] + [str(a) for a in script_args], cwd=os.path.dirname(script), check=True)
+
+def build_network(cache, args):
+    ### Network stages, their outputs are in 0_network/data/<region>/
+    scripts = absolute_path+'/0_network/scripts'
+    data = absolute_path+'/0_network/data/{}'.format(args.region)
+    osm_file = data+'/target.osm'
+    if args.bbox is not None:
+        os.makedirs(data, exist_ok=True)
+        cache.run('download_{}'.format(args.region), lambda: download_osm(args.bbox, osm_file),
+            params={'bbox': args.bbox}, outputs=[osm_file], force=args.force)
+
+    ### --tiles, --processes and --streaming change how the network is built, not what is built, so they are not parameters of the stage
+    osm2json_args = ['--region', args.region, '--tiles', args.tiles, '--processes', args.processes] + (['--streaming'] if args.streaming else [])
+    cache.run('osm2json_{}'.format(args.region), lambda: run_script(scripts+'/1_osm2json.py', *osm2json_args),
+        inputs=[osm_file, scripts+'/1_osm2json.py', scripts+'/osm_reader.py', scripts+'/haversine.py'],
+        outputs=[data+'/nodes.json', data+'/ways.json'], force=args.force)
+    cache.run('json2graph_{}'.format(args.region), lambda: run_script(scripts+'/2_json2graph.py', args.region),
+        inputs=[data+'/nodes.json', data+'/ways.json', scripts+'/2_json2graph.py', absolute_path+'/utilities/csr_graph.py'],
+        outputs=[data+'/network_csr', data+'/node_osmid2graphid.json'], force=args.force)
+    if args.mtx:
+        cache.run('graph_to_mtx_{}'.format(args.region), lambda: run_script(scripts+'/3_graph_to_mtx.py', args.region),
+            inputs=[data+'/network_csr', scripts+'/3_graph_to_mtx.py'],
+            outputs=[data+'/network_sparse.mtx'], force=args.force)
+    return data
+
+def build_OD(cache, args, network_folder):
+    ### OD stages, their outputs are in 1_OD/output/
+    OD_folder = absolute_path+'/1_OD'
+    sys.path.insert(0, OD_folder)
+    import OD2csv ### geopandas is only needed from here on
+
+    taz_nodes_file = OD_folder+'/output/taz_nodes.json'
+    os.makedirs(OD_folder+'/output', exist_ok=True)
+    cache.run('taz_nodes_{}'.format(args.region), lambda: OD2csv.TAZ_nodes(network_folder=network_folder),
+        inputs=[OD_folder+'/TAZ981', network_folder+'/nodes.json', OD_folder+'/OD2csv.py'],
+        outputs=[taz_nodes_file], force=args.force)
+
+    ### One stage per slice, so that only the slices out of date are rebuilt; they are generated together by OD2csv.batch_OD,
+    ### which loads the TNC data and the node lists once (each slice has its own seed, so this does not change the OD tables)
+    OD_input_files = [OD_folder+'/TNC_pickups_dropoffs.csv', taz_nodes_file, network_folder+'/node_osmid2graphid.json',
+        OD_folder+'/OD2csv.py', absolute_path+'/utilities/od_table.py']
+    OD_stages = []
+    for day in args.days:
+        for hour in args.hours:
+            OD_name = OD_folder+'/output/SF_graph_DY{}_HR{}_OD_{}'.format(day, hour, args.count)
+            OD_stages.append(('OD_{}_DY{}_HR{}_{}'.format(args.region, day, hour, args.count), (day, hour),
+                {'day': day, 'hour': hour, 'count': args.count, 'seed': args.seed, 'csv': args.csv},
+                [OD_name] + ([OD_name+'.csv'] if args.csv else [])))
+    stale_stages = []
+    for (name, OD_slice, params, outputs) in OD_stages:
+        cache.check_inputs(name, OD_input_files)
+        if not args.force and cache.is_current(name, OD_input_files, params, outputs):
+            print('{}: up to date'.format(name))
+        else:
+            stale_stages.append((name, OD_slice, params, outputs))
+    if stale_stages:
+        print('{}: building'.format(', '.join(name for (name, OD_slice, params, outputs) in stale_stages)))
+        OD2csv.batch_OD(None, None, args.count, seed=args.seed, processes=args.processes, csv_output=args.csv,
+            network_folder=network_folder, slices=[OD_slice for (name, OD_slice, params, outputs) in stale_stages])
+        for (name, OD_slice, params, outputs) in stale_stages:
+            cache.record(name, OD_input_files, params, outputs)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Build the network and OD tables, skipping the stages that are up to date')
+    parser.add_argument('--region', default='sf', help='region folder under 0_network/data/')
+    parser.add_argument('--bbox', default=None, help='south,west,north,east; download target.osm from overpass for this bounding box')
+    parser.add_argument('--tiles', type=int, default=1, help='see 1_osm2json.py')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes of 1_osm2json.py and of the OD generation')
+    parser.add_argument('--streaming', action='store_true', help='see 1_osm2json.py')
+    parser.add_argument('--mtx', action='store_true', help='also export the graph for sp (3_graph_to_mtx.py)')
+    parser.add_argument('--network-only', action='store_true', help='stop after the network stages')
+    parser.add_argument('--days', type=int, nargs='+', default=[1], help='days of week of the OD tables, Monday is 0')
+    parser.add_argument('--hours', type=int, nargs='+', default=[9, 10], help='hours of the OD tables, from 3 to 26')
+    parser.add_argument('--count', type=int, default=50000, help='number of OD pairs sampled per hour')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the OD sampling')
+    parser.add_argument('--csv', action='store_true', help='also write the OD tables as csv')
+    parser.add_argument('--force', action='store_true', help='rebuild every stage')
+    parser.add_argument('--manifest', default=absolute_path+'/build_cache.json', help='build cache manifest file')
+    return parser.parse_args(argv)
+
+def main(args=None):
+    if args is None: args = parse_args()
+    cache = BuildCache(args.manifest)
+    network_folder = build_network(cache, args)
+    if not args.network_only:
+        build_OD(cache, args, network_folder)
+
+if __name__ == '__main__':
+    main()
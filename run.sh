@@ -1,3 +1,4 @@
 #!/bin/sh
-module load python/3.5.1
-/usr/local/Cluster-Apps/python/3.5.1/bin/python3 2_ABM/sf_abm_mp_profile.py
+### The ABM needs Python 3.8+ (multiprocessing.shared_memory, numpy.random.default_rng); load a module that provides it on your HPC system
+module load python/3.8
+python3 2_ABM/sf_abm_mp_profile.py "$@"
@@ -0,0 +1,86 @@
+### Content-hashed build cache for the network and OD artifacts
+### Each stage of the data pipeline is recorded in a json manifest with the hashes of its input files, its parameters
+### (bbox, day, hour, count, seed, ...) and the hashes of its outputs. A stage is rebuilt only if one of them changed,
+### or if an output is missing or was modified after the build.
+### Folders (e.g., the CSR graph bundle or a binary OD table) are hashed over all the files they contain.
+import hashlib
+import json
+import os
+
+hash_chunk_size = 1 << 20 ### bytes read at once when hashing a file
+
+def file_hash(path, known_hashes=None):
+    ### sha256 of a file, or of all files in a folder (with their relative paths); None if the path does not exist
+    ### known_hashes: {path: [size, mtime_ns, hash]}, so that large unchanged files (e.g., target.osm) are not read again
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                sub_path = os.path.join(root, name)
+                digest.update(os.path.relpath(sub_path, path).encode('utf-8'))
+                digest.update(file_hash(sub_path, known_hashes).encode('utf-8'))
+        return digest.hexdigest()
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    if known_hashes is not None:
+        known = known_hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+            digest.update(chunk)
+    if known_hashes is not None:
+        known_hashes[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+class BuildCache(object):
+    ### The manifest of all stages built so far, stored in manifest_file:
+    ### {'stages': {stage_name: {'inputs': {path: hash}, 'params': {...}, 'outputs': {path: hash}}}, 'files': {path: [size, mtime_ns, hash]}}
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        if os.path.isfile(manifest_file):
+            self.manifest = json.load(open(manifest_file))
+        else:
+            self.manifest = {'stages': {}, 'files': {}}
+
+    def hashes(self, paths):
+        return {path: file_hash(path, self.manifest['files']) for path in paths}
+
+    def is_current(self, name, inputs, params, outputs):
+        ### True if the stage was built from the same input contents and parameters, and its outputs are unchanged
+        record = self.manifest['stages'].get(name)
+        if record is None: return False
+        if record['params'] != json.loads(json.dumps(params)): return False
+        if sorted(record['inputs']) != sorted(inputs) or record['inputs'] != self.hashes(inputs): return False
+        output_hashes = self.hashes(outputs)
+        if None in output_hashes.values(): return False
+        return record['outputs'] == output_hashes
+
+    def record(self, name, inputs, params, outputs):
+        ### Save the stage after a successful build
+        self.manifest['stages'][name] = {'inputs': self.hashes(inputs), 'params': params, 'outputs': self.hashes(outputs)}
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self.manifest, outfile, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+    def check_inputs(self, name, inputs):
+        ### A missing input is an error, as the stage could not be reproduced from it
+        missing = [path for path in inputs if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError('stage {} is missing its inputs {}'.format(name, missing))
+
+    def run(self, name, build, inputs=(), params=None, outputs=(), force=False):
+        ### Run build() unless the stage is current; return True if it was (re)built
+        inputs, outputs, params = list(inputs), list(outputs), (params or {})
+        self.check_inputs(name, inputs)
+        if not force and self.is_current(name, inputs, params, outputs):
+            print('{}: up to date'.format(name))
+            return False
+        print('{}: building'.format(name))
+        build()
+        self.record(name, inputs, params, outputs)
+        return True
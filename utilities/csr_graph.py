@@ -0,0 +1,63 @@
+### Binary CSR graph bundle
+### The road network as a folder of .npy files, so that it can be np.load(mmap_mode='r') without unpickling or parsing text:
+###  * topology in compressed sparse row form: the out-edges of node v are at positions indptr[v]:indptr[v+1] of indices (target node) and edge_ids (edge ID on graph)
+###  * edge attributes indexed by edge ID on graph: edge_osmid, type, lanes, maxmph, capacity, length (m), fft (free flow time, s)
+###  * node attributes indexed by node ID on graph: node_osmid, node_x (lon), node_y (lat)
+import json
+import os
+import numpy as np
+import scipy.sparse
+import scipy.io as sio
+
+CSR_GRAPH_VERSION = 1
+CSR_ARRAYS = ('indptr', 'indices', 'edge_ids')
+
+def csr_from_edgelist(sources, targets, vcount):
+    ### CSR topology of a directed graph whose edge i goes from sources[i] to targets[i]
+    sources = np.asarray(sources, dtype=np.int32)
+    targets = np.asarray(targets, dtype=np.int32)
+    edge_ids = np.argsort(sources, kind='stable').astype(np.int32)
+    indptr = np.zeros(vcount+1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=vcount), out=indptr[1:])
+    indices = targets[edge_ids]
+    return indptr, indices, edge_ids
+
+def edge_endpoints(graph):
+    ### Source and target node of each edge, indexed by edge ID on graph
+    vcount = len(graph['indptr'])-1
+    sources = np.empty(len(graph['edge_ids']), dtype=np.int32)
+    targets = np.empty(len(graph['edge_ids']), dtype=np.int32)
+    sources[graph['edge_ids']] = np.repeat(np.arange(vcount, dtype=np.int32), np.diff(graph['indptr']))
+    targets[graph['edge_ids']] = graph['indices']
+    return sources, targets
+
+def write_csr_graph(folder, sources, targets, vcount, edge_attrs, node_attrs):
+    ### Save the graph with edge i from sources[i] to targets[i] as a CSR bundle in folder
+    ### edge_attrs and node_attrs are dictionaries of arrays, indexed by edge ID and node ID on graph
+    os.makedirs(folder, exist_ok=True)
+    arrays = dict(zip(CSR_ARRAYS, csr_from_edgelist(sources, targets, vcount)))
+    arrays.update({name: np.asarray(values) for name, values in edge_attrs.items()})
+    arrays.update({name: np.asarray(values) for name, values in node_attrs.items()})
+    for name, array in arrays.items():
+        np.save(os.path.join(folder, name+'.npy'), array)
+    meta = {
+        'version': CSR_GRAPH_VERSION, 'vcount': int(vcount), 'ecount': len(arrays['edge_ids']),
+        'edge_attrs': sorted(edge_attrs), 'node_attrs': sorted(node_attrs)}
+    with open(os.path.join(folder, 'meta.json'), 'w') as outfile:
+        json.dump(meta, outfile, indent=2)
+
+def read_csr_graph(folder, mmap_mode='r'):
+    ### Return a dictionary of the topology and attribute arrays, memory-mapped by default
+    meta = json.load(open(os.path.join(folder, 'meta.json')))
+    if meta['version'] != CSR_GRAPH_VERSION:
+        raise ValueError('graph {} has version {}, expected {}'.format(folder, meta['version'], CSR_GRAPH_VERSION))
+    names = list(CSR_ARRAYS) + meta['edge_attrs'] + meta['node_attrs']
+    graph = {name: np.load(os.path.join(folder, name+'.npy'), mmap_mode=mmap_mode) for name in names}
+    graph['vcount'], graph['ecount'] = meta['vcount'], meta['ecount']
+    return graph
+
+def write_matrix_market(graph, mtx_file, weight='length'):
+    ### Export the graph as a sparse adjacency matrix in Matrix Market format, as read by the sp shortest path library
+    sources, targets = edge_endpoints(graph)
+    g_coo = scipy.sparse.coo_matrix((graph[weight], (sources, targets)), shape=(graph['vcount'], graph['vcount']))
+    sio.mmwrite(mtx_file, g_coo)
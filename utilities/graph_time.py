@@ -10,7 +10,11 @@ sys.path.insert(0, '/Users/bz247')
 from sp import interface 
 
 absolute_path = os.path.dirname(os.path.abspath(__file__))
+from csr_graph import read_csr_graph, edge_endpoints, write_matrix_market
+graph = read_csr_graph(absolute_path+'/../0_network/data/sf/network_csr')
 graph_file = absolute_path+'/../0_network/data/sf/network_sparse.mtx'
+if not os.path.isfile(graph_file):
+	write_matrix_market(graph, graph_file, weight='length')
 
 ### Time the PQ
 print('########### Priority Queue SP #############')
@@ -30,11 +34,9 @@ print('PQ: total time {}, dijkstra() {}, route() {}, vertex list {}, \n'.format(
 
 # Time igraph
 print('############## igraph ################')
-g_csr = sio.mmread(graph_file)
-g_coo = scipy.sparse.coo_matrix(g_csr)
-source, target = g_coo.nonzero()
+source, target = edge_endpoints(graph)
 edgelist = list(zip(source.tolist(), target.tolist()))
-g_igraph = igraph.Graph(max(g_coo.shape), edgelist, edge_attrs={'weight': g_coo.data.tolist()}, directed=True)
+g_igraph = igraph.Graph(graph['vcount'], edgelist, edge_attrs={'weight': graph['length'].tolist()}, directed=True)
 print(g_igraph.summary())
 
 distance_igraph = g_igraph.shortest_paths_dijkstra(1019, 19, weights='weight')
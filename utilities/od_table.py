@@ -0,0 +1,42 @@
+### Binary columnar OD table
+### int32 O, int32 D, float32 flow, sorted by O, plus an origin offset index: the rows of origins[i] are offsets[i]:offsets[i+1]
+### Each column is a .npy file in one folder, so that the ABM workers can np.load(mmap_mode='r') it and read slices without copying
+import json
+import os
+import numpy as np
+import pandas as pd
+
+OD_TABLE_VERSION = 1
+OD_TABLE_COLUMNS = {'O': np.int32, 'D': np.int32, 'flow': np.float32, 'origins': np.int32, 'offsets': np.int64}
+
+def write_od_table(folder, O, D, flow):
+    ### Sort the rows by origin, build the origin offset index and save each column as .npy in folder
+    O = np.asarray(O, dtype=np.int32)
+    order = np.argsort(O, kind='stable')
+    origins, counts = np.unique(O, return_counts=True)
+    offsets = np.zeros(len(origins)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    columns = {
+        'O': O[order],
+        'D': np.asarray(D, dtype=np.int32)[order],
+        'flow': np.asarray(flow, dtype=np.float32)[order],
+        'origins': origins.astype(np.int32),
+        'offsets': offsets}
+
+    os.makedirs(folder, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(folder, name+'.npy'), column)
+    with open(os.path.join(folder, 'meta.json'), 'w') as outfile:
+        json.dump({'version': OD_TABLE_VERSION, 'rows': len(O), 'origins': len(origins)}, outfile, indent=2)
+
+def read_od_table(folder, mmap_mode='r'):
+    ### Return a dictionary of the columns, memory-mapped by default
+    meta = json.load(open(os.path.join(folder, 'meta.json')))
+    if meta['version'] != OD_TABLE_VERSION:
+        raise ValueError('OD table {} has version {}, expected {}'.format(folder, meta['version'], OD_TABLE_VERSION))
+    return {name: np.load(os.path.join(folder, name+'.npy'), mmap_mode=mmap_mode) for name in OD_TABLE_COLUMNS}
+
+def csv_to_od_table(csv_file, folder):
+    ### Convert an OD table in the csv format (columns O, D, flow) to the binary format
+    OD = pd.read_csv(csv_file, usecols=['O', 'D', 'flow'])
+    write_od_table(folder, OD['O'].values, OD['D'].values, OD['flow'].values)
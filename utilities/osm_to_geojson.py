@@ -7,6 +7,7 @@ import haversine
 import re
 import sys
 import random
+from results_writer import write_geojson
 
 def osm_to_geojson(folder='sf'):
     # Load OSM data as downloaded from overpass
@@ -22,37 +23,16 @@ def osm_to_geojson(folder='sf'):
     all_ways = [w_e for w_e in osm_data if w_e['type']=='way']
     print('it includes {} nodes'.format(len(all_ways)))
 
-    nodes_feature_list = []
-    for k, v in all_nodes.items():
-        node_feature = {
-            'type': 'Feature', 
-            'geometry': {'type': 'Point', 'coordinates': v[1], v[0]},
-            'properties': {'osmid': k}
-            }
-        nodes_feature_list.append(node_feature)
-    nodes_geojson = {'type': 'FeatureCollection', 'features': nodes_feature_list}
-
-    links_feature_list = []
-    for w in all_ways:
-        link_feature = {
-            'type': 'Feature', 
-            'geometry': {
-                'type': 'LineString', 
-                'coordinates': [[all_nodes[n][1], all_nodes[n][0]] for n in w['nodes']]
-                },
-            'properties': {
-                'osmid': w['id'],
-                'type': w['tags']['highway']
-                }
-            }
-        links_feature_list.append(link_feature)
-    links_geojson = {'type': 'FeatureCollection', 'features': links_feature_list}
-
-    with open('{}/osm_links.geojson'.format(folder), 'w') as links_outfile:
-        json.dump(links_geojson, links_outfile, indent=2)
-
-    with open('{}/osm_nodes.geojson'.format(folder), 'w') as nodes_outfile:
-        json.dump(nodes_geojson, nodes_outfile, indent=2)
+    node_ids = np.array(list(all_nodes.keys()), dtype=np.int64)
+    node_coords = np.array(list(all_nodes.values()), dtype=np.float64).reshape(-1, 2) ### lat, lon
+    write_geojson('{}/osm_nodes.geojson'.format(folder), node_coords[:, ::-1], {'osmid': node_ids})
+
+    way_offsets = np.zeros(len(all_ways)+1, dtype=np.int64)
+    np.cumsum([len(w['nodes']) for w in all_ways], out=way_offsets[1:])
+    way_coords = np.array([all_nodes[n][::-1] for w in all_ways for n in w['nodes']], dtype=np.float64).reshape(-1, 2) ### lon, lat
+    write_geojson('{}/osm_links.geojson'.format(folder), way_coords,
+        {'osmid': np.array([w['id'] for w in all_ways], dtype=np.int64), 'type': [w['tags']['highway'] for w in all_ways]},
+        offsets=way_offsets)
 
 if __name__ == '__main__':
     osm_to_geojson(folder = 'sf')
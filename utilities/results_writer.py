@@ -0,0 +1,118 @@
+### Write network and link-level results for visualization and analysis
+### GeoJSON FeatureCollections are streamed to disk feature by feature from coordinate and attribute arrays,
+### so the document is never held in memory as nested dictionaries:
+###  * Points: coordinates[i] is the (lon, lat) of feature i;
+###  * LineStrings: the vertices of feature i are coordinates[offsets[i]:offsets[i+1]].
+### For hourly link results, LinkResults writes the static edge geometry once (links.geojson, with the gid of each edge)
+### and each hour as compact columns indexed by gid, either .npy files or a Parquet table (needs pyarrow);
+### the full GeoJSON of an hour can still be written, reusing the geometry encoded once.
+import json
+import math
+import os
+import numpy as np
+
+feature_chunk_size = 100000 ### features encoded and written at once
+
+def json_values(values):
+    ### JSON text of each value of a column
+    values = np.asarray(values)
+    if values.dtype.kind == 'b':
+        return ['true' if v else 'false' for v in values.tolist()]
+    if values.dtype.kind in 'iu':
+        return [str(v) for v in values.tolist()]
+    if values.dtype.kind == 'f':
+        ### NaN and infinite values (e.g., the speed on a link of zero length) have no JSON number, they are written as null
+        return [repr(v) if math.isfinite(v) else 'null' for v in values.tolist()]
+    return [json.dumps(v) for v in values.tolist()]
+
+def geometry_strings(coordinates, offsets=None, start=0, end=None):
+    ### JSON text of the geometry of features start to end
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if offsets is None:
+        end = len(coordinates) if end is None else end
+        return ['{{"type": "Point", "coordinates": [{}, {}]}}'.format(x, y) for (x, y) in coordinates[start:end].tolist()]
+    end = len(offsets)-1 if end is None else end
+    vertices = ['[{}, {}]'.format(x, y) for (x, y) in coordinates[offsets[start]:offsets[end]].tolist()]
+    chunk_offsets = (np.asarray(offsets[start:end+1]) - offsets[start]).tolist()
+    return ['{{"type": "LineString", "coordinates": [{}]}}'.format(', '.join(vertices[i:j])) for (i, j) in zip(chunk_offsets[:-1], chunk_offsets[1:])]
+
+def feature_strings(geometries, properties, start, end):
+    ### JSON text of features start to end, with the geometry strings of these features and the property columns
+    names = [json.dumps(name) for name in properties]
+    columns = [json_values(np.asarray(values)[start:end]) for values in properties.values()]
+    return ['{{"type": "Feature", "geometry": {}, "properties": {{{}}}}}'.format(
+        geometry, ', '.join('{}: {}'.format(name, value) for (name, value) in zip(names, row)))
+        for geometry, row in zip(geometries, zip(*columns) if columns else ([()]*len(geometries)))]
+
+def write_geojson(path, coordinates, properties, offsets=None, geometries=None):
+    ### Stream a FeatureCollection to path, one feature per line
+    ### properties: {name: array with one value per feature}; geometries: the geometry strings of all features, if already encoded
+    feature_count = (len(coordinates) if offsets is None else len(offsets)-1) if geometries is None else len(geometries)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        outfile.write('{"type": "FeatureCollection", "features": [\n')
+        for start in range(0, feature_count, feature_chunk_size):
+            end = min(start+feature_chunk_size, feature_count)
+            chunk_geometries = geometries[start:end] if geometries is not None else geometry_strings(coordinates, offsets, start, end)
+            if start > 0: outfile.write(',\n')
+            outfile.write(',\n'.join(feature_strings(chunk_geometries, properties, start, end)))
+        outfile.write('\n]}\n')
+    os.replace(tmp_path, path) ### readers never see a partial file
+
+def edge_geometry(graph):
+    ### Straight line geometry of each edge of a CSR graph (csr_graph.py), indexed by edge ID on graph
+    from csr_graph import edge_endpoints
+    sources, targets = edge_endpoints(graph)
+    coordinates = np.empty((2*graph['ecount'], 2))
+    coordinates[0::2, 0], coordinates[0::2, 1] = graph['node_x'][sources], graph['node_y'][sources]
+    coordinates[1::2, 0], coordinates[1::2, 1] = graph['node_x'][targets], graph['node_y'][targets]
+    return coordinates, np.arange(0, 2*graph['ecount']+1, 2)
+
+class LinkResults(object):
+    ### Hourly link volumes and speeds of a graph, written to folder in output_format:
+    ###  * 'npy': DY{day}_HR{hour}/volume.npy and speed.npy, float32 arrays indexed by gid;
+    ###  * 'parquet': DY{day}_HR{hour}.parquet with the columns gid, volume and speed;
+    ###  * 'geojson': DY{day}_HR{hour}.geojson, the link features with their volume and speed, as read by DeckGL.
+    ### The static geometry (links.geojson: link_id, gid) is written once, with the first hour
+    def __init__(self, folder, graph, output_format='npy'):
+        if output_format not in ('npy', 'parquet', 'geojson'):
+            raise ValueError('unknown output format {}'.format(output_format))
+        self.folder, self.graph, self.output_format = folder, graph, output_format
+        self.geometries = None
+        self.static_written = False
+
+    def write_static(self):
+        coordinates, offsets = edge_geometry(self.graph)
+        if self.output_format == 'geojson':
+            ### Encoded once and reused by every hour; the compact formats do not keep them in memory
+            self.geometries = []
+            for start in range(0, self.graph['ecount'], feature_chunk_size):
+                self.geometries += geometry_strings(coordinates, offsets, start, min(start+feature_chunk_size, self.graph['ecount']))
+        os.makedirs(self.folder, exist_ok=True)
+        write_geojson(os.path.join(self.folder, 'links.geojson'), coordinates, {
+            'link_id': self.graph['edge_osmid'], 'gid': np.arange(self.graph['ecount'])}, offsets=offsets, geometries=self.geometries)
+        self.static_written = True
+
+    def write_hour(self, day, hour, volume_array, t_new):
+        ### Return the path of the output of this hour
+        if not self.static_written: self.write_static()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.asarray(self.graph['length']) / t_new ### m/s
+        name = os.path.join(self.folder, 'DY{}_HR{}'.format(day, hour))
+        if self.output_format == 'geojson':
+            write_geojson(name+'.geojson', None, {
+                'link_id': self.graph['edge_osmid'], 'query_weekend': np.full(len(speed), day), 'query_hour': np.full(len(speed), hour),
+                'sec_speed': speed, 'sec_volume': np.asarray(volume_array, dtype=np.float64)}, geometries=self.geometries)
+            return name+'.geojson'
+        volume, speed = np.asarray(volume_array, dtype=np.float32), speed.astype(np.float32)
+        if self.output_format == 'npy':
+            os.makedirs(name, exist_ok=True)
+            np.save(os.path.join(name, 'volume.npy'), volume)
+            np.save(os.path.join(name, 'speed.npy'), speed)
+            return name
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.table({'gid': np.arange(len(volume), dtype=np.int32), 'volume': volume, 'speed': speed})
+            pyarrow.parquet.write_table(table, name+'.parquet')
+            return name+'.parquet'